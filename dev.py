@@ -20,6 +20,10 @@ allowed_origins = [
     'http://localhost:8040',
     'http://localhost:8080']
 
+metrics_allowed_ips = [
+    '127.0.0.1',
+    '::1']
+
 jwt_secret = 'secret'
 public_scheme = 'http'
 public_domain = 'localhost'
@@ -27,6 +27,13 @@ setup(
         'tornado'
     ],
     extras_require={
+        'speedups': [
+            'ujson>=5'
+        ],
+        'asyncio': [
+            'asyncpg',
+            'sqlalchemy[asyncio]>=1.4'
+        ],
         'test': [
             'asynctest',
             'codecov',
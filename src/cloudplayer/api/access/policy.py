@@ -5,9 +5,12 @@
     :copyright: (c) 2018 by Nicolas Drebenstedt
     :license: GPL-3.0, see LICENSE for details
 """
+import functools
+
 from cloudplayer.api import APIException
 from cloudplayer.api.access.action import Create, Delete, Query, Read, Update
 from cloudplayer.api.access.fields import Available, Fields
+from cloudplayer.api.access.principal import Everyone, Owner
 
 
 class PolicyViolation(APIException):
@@ -16,6 +19,23 @@ class PolicyViolation(APIException):
         super().__init__(status_code, log_message)
 
 
+@functools.lru_cache(maxsize=4096)
+def compile_acl(acl, action, values):
+    """Compile the rules of `acl` into decisions for `action` on `values`.
+
+    The decision table keeps the rule order and only retains rules whose
+    action and fields match, so that granting merely has to check their
+    principals. Returns `None` for access control lists that contain
+    anything but allow and deny rules.
+    """
+    from cloudplayer.api.access.rule import Rule
+    if not all(isinstance(rule, Rule) for rule in acl):
+        return
+    fields = Available if values is Available else Fields(*values)
+    decisions = (rule.compile(action, fields) for rule in acl)
+    return tuple(d for d in decisions if d is not None)
+
+
 class Policy(object):
     """Operator class that can verify the compliance of CRUD operations.
 
@@ -27,8 +47,36 @@ class Policy(object):
         self.db = db
         self.current_user = current_user
 
+    @staticmethod
+    def decide(action, target, fields):
+        """Look up the compiled decisions or `None` if there are none."""
+        if fields is Available:
+            values = Available
+        elif isinstance(fields, Available):
+            return
+        elif isinstance(fields, Fields):
+            values = fields._values
+        else:
+            values = frozenset(fields)
+        try:
+            return compile_acl(target.__acl__, action, values)
+        except TypeError:  # Unhashable access control list
+            return
+
     @staticmethod
     def grant(account, action, target, fields):
+        decisions = Policy.decide(action, target, fields)
+        if decisions is None:
+            return Policy.evaluate(account, action, target, fields)
+        for decision in decisions:
+            grant = decision(account, action, target)
+            if grant:
+                return grant
+        raise PolicyViolation(404, 'no grant issued')
+
+    @staticmethod
+    def evaluate(account, action, target, fields):
+        """Walk the access control list of `target` rule by rule."""
         if fields is not Available and not isinstance(fields, Fields):
             fields = Fields(*fields)
         for rule in target.__acl__:
@@ -41,7 +89,6 @@ class Policy(object):
         return self.grant(account, Create, entity, fields)
 
     def grant_read(self, account, entity_or_entities, fields):
-        # TODO: Find a better way to grant multi reads
         if isinstance(entity_or_entities, list):
             return self._grant_multi_read(account, entity_or_entities, fields)
         else:
@@ -52,10 +99,41 @@ class Policy(object):
         entity.fields = grant.fields
         return grant
 
+    @staticmethod
+    def _read_group(entity, fields):
+        """Key of entities that are certain to share a read grant.
+
+        Decisions on `Everyone` do not depend on the entity at all and
+        the ones on `Owner` only on its owner, so such entities can be
+        grouped by access control list and owner. Entities that need to
+        be evaluated on their own have no key.
+        """
+        decisions = Policy.decide(Read, entity, fields)
+        if decisions is None:
+            return
+        principals = {decision.principal for decision in decisions}
+        if principals <= {Everyone}:
+            return entity.__acl__, None
+        if principals <= {Everyone, Owner}:
+            owner = entity.account
+            if owner is None:
+                return entity.__acl__, None
+            return entity.__acl__, (owner.id, owner.provider_id)
+
     def _grant_multi_read(self, account, entities, fields):
+        from cloudplayer.api.access.rule import Grant
         grants = []
+        groups = {}
         for entity in entities:
-            grant = self._grant_solo_read(account, entity, fields)
+            key = self._read_group(entity, fields)
+            if key is None:
+                grant = self._grant_solo_read(account, entity, fields)
+            else:
+                if key not in groups:
+                    groups[key] = self.grant(account, Read, entity, fields)
+                shared = groups[key]
+                grant = Grant(account, Read, entity, shared.fields)
+                entity.fields = shared.fields
             grants.append(grant)
         return grants
 
@@ -21,6 +21,28 @@ class Grant(object):
         self.fields = fields
 
 
+class Decision(object):
+    """Precompiled rule whose action and fields are known to match.
+
+    Only the principal remains to be checked against the target.
+    """
+
+    __slots__ = ('principal', 'fields', 'allow')
+
+    def __init__(self, principal, fields, allow):
+        self.principal = principal
+        self.fields = fields
+        self.allow = allow
+
+    def __call__(self, account, action, target):
+        if self.principal is not Everyone:
+            if self.principal(target) != Principal(account):
+                return
+        if not self.allow:
+            raise PolicyViolation(403, 'operation forbidden')
+        return Grant(account, action, target, self.fields)
+
+
 class Rule(object):
     """Main ACL entry declaring a certain action allowed or denied."""
 
@@ -29,6 +51,13 @@ class Rule(object):
         self.action = action
         self.fields = fields
 
+    def compile(self, action, fields):
+        """Match `action` and `fields` independently of any target.
+
+        Returns a decision if the rule applies or `None` otherwise.
+        """
+        raise NotImplementedError()  # pragma: no cover
+
 
 class Allow(Rule):
     """Rule that allows an actor to act on a set of target fields."""
@@ -53,6 +82,16 @@ class Allow(Rule):
         if proposed_fields in required_fields:
             return grant
 
+    def compile(self, action, fields):
+        if self.action(None) != action(None):
+            return
+        required_fields = self.fields(None)
+        if fields(None) not in required_fields:
+            return
+        if fields is Available:
+            return Decision(self.principal, required_fields, True)
+        return Decision(self.principal, fields, True)
+
 
 class Deny(Rule):
     """Rule that denies an actor to act on a set of target fields."""
@@ -62,3 +101,8 @@ class Deny(Rule):
             if self.action(target) == action(target):
                 if fields(target) in self.fields(target):
                     raise PolicyViolation(403, 'operation forbidden')
+
+    def compile(self, action, fields):
+        if self.action(None) == action(None):
+            if fields(None) in self.fields(None):
+                return Decision(self.principal, None, False)
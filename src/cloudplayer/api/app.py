@@ -8,21 +8,35 @@
 import functools
 import signal
 import sys
+import time
+import types
 
 import bugsnag
 import redis
+import redis.exceptions
 import sqlalchemy as sql
 import sqlalchemy.orm as orm
+import sqlalchemy.pool
 import tornado.concurrent
+import tornado.gen
 import tornado.httpclient
 import tornado.ioloop
+import tornado.locks
 import tornado.options as opt
 import tornado.web
 from sqlalchemy import event
 from tornado.log import app_log
 
+from cloudplayer.api.cache import LRUCache, SingleFlight, TieredCache
+from cloudplayer.api.metrics import Metrics
+from cloudplayer.api.pubsub import Listener, Multiplexer
 from cloudplayer.api.routing import ProtocolMatches
 
+try:
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+except ImportError:  # pragma: no cover
+    AsyncSession = create_async_engine = None
+
 
 def define_options():  # pragma: no cover
     """Defines global configuration options"""
@@ -32,12 +46,30 @@ def define_options():  # pragma: no cover
     opt.define('connect_timeout', type=int, default=1, group='httpclient')
     opt.define('request_timeout', type=int, default=3, group='httpclient')
     opt.define('max_redirects', type=int, default=1, group='httpclient')
+    opt.define('http_max_clients', type=int, default=50, group='app')
+    opt.define('http_max_host_connections', type=int, default=10,
+               group='app')
+    opt.define('http_tcp_keepalive', type=bool, default=True, group='app')
     opt.define('debug', type=bool, group='app')
     opt.define('xheaders', type=bool, group='app')
     opt.define('static_path', type=str, group='app')
     opt.define('jwt_cookie', default='tok_v1', group='app')
     opt.define('jwt_expiration', default=30, group='app')
     opt.define('jwt_secret', type=str, group='app')
+    opt.define('jwt_cache_size', type=int, default=4096, group='app')
+    opt.define('track_cache_size', type=int, default=4096, group='app')
+    opt.define('track_cache_ttl', type=dict, default={
+        'soundcloud': 3600, 'youtube': 3600}, group='app')
+    opt.define('search_cache_size', type=int, default=1024, group='app')
+    opt.define('search_cache_ttl', type=int, default=600, group='app')
+    opt.define('hydrate_concurrency', type=int, default=4, group='app')
+    opt.define('search_budget', type=float, default=2.0, group='app')
+    opt.define('max_page_size', type=int, default=500, group='app')
+    # Every stream holds a pooled connection for its server side cursor
+    # until the client read the last batch, so slow clients take up
+    # connections of `postgres_pool_size` for as long as they read
+    opt.define('stream_batch_size', type=int, default=100, group='app')
+    opt.define('rank_rebalance_length', type=int, default=32, group='app')
     opt.define('public_domain', default='api.cloud-player.io', group='app')
     opt.define('public_scheme', default='https', group='app')
     opt.define('youtube', type=dict, group='app')
@@ -46,8 +78,13 @@ def define_options():  # pragma: no cover
     opt.define('cloudplayer', type=dict, group='app')
     opt.define('providers', type=list, group='app')
     opt.define('allowed_origins', type=list, group='app')
+    # Checked against the socket peer, which is the proxy behind one
+    opt.define('metrics_allowed_ips', type=list, default=[], group='app')
     opt.define('num_executors', type=int, default=1, group='app')
+    opt.define('offload_database', type=bool, default=False, group='app')
+    opt.define('async_database', type=bool, default=False, group='app')
     opt.define('redirect_state', type=str, default='v3', group='app')
+    opt.define('token_refresh_margin', type=int, default=300, group='app')
     opt.define('redis_host', type=str, default='127.0.0.1', group='app')
     opt.define('redis_port', type=int, default=6379, group='app')
     opt.define('redis_db', type=int, default=0, group='app')
@@ -57,6 +94,11 @@ def define_options():  # pragma: no cover
     opt.define('postgres_db', type=str, default='cloudplayer', group='app')
     opt.define('postgres_user', type=str, default='api', group='app')
     opt.define('postgres_password', type=str, default='password', group='app')
+    opt.define('postgres_pool_size', type=int, default=5, group='app')
+    opt.define('postgres_max_overflow', type=int, default=10, group='app')
+    opt.define('postgres_pool_timeout', type=int, default=30, group='app')
+    opt.define('postgres_pool_recycle', type=int, default=-1, group='app')
+    opt.define('postgres_pool_pre_ping', type=bool, default=False, group='app')
     opt.parse_config_file(opt.options.config)
 
 
@@ -157,6 +199,8 @@ class Application(tornado.web.Application):
 
         (r'^/health_check$',
          'cloudplayer.api.http.base.HTTPHealth'),
+        (r'^/metrics$',
+         'cloudplayer.api.http.base.HTTPMetrics'),
         (r'^/.*',
          'cloudplayer.api.http.base.HTTPFallback'),
     ]
@@ -170,6 +214,9 @@ class Application(tornado.web.Application):
          r'\.(?P<id>[0-9a-zA-Z]+)$',
          'cloudplayer.api.ws.playlist.Entity'),
 
+        (r'^track$',
+         'cloudplayer.api.ws.track.Collection'),
+
         (r'^user\.(?P<id>me|[0-9]+)$',
          'cloudplayer.api.ws.user.Entity'),
 
@@ -193,6 +240,10 @@ class Application(tornado.web.Application):
         self.executor = tornado.concurrent.futures.ThreadPoolExecutor(
             settings['num_executors'])
 
+        self.metrics = Metrics()
+
+        self.jwt_cache = LRUCache(settings['jwt_cache_size'])
+
         self.redis_pool = RedisPool(
             settings['redis_host'],
             settings['redis_port'],
@@ -204,13 +255,51 @@ class Application(tornado.web.Application):
             settings['postgres_password'],
             settings['postgres_host'],
             settings['postgres_port'],
-            settings['postgres_db'])
+            settings['postgres_db'],
+            executor=(
+                self.executor if settings['offload_database'] else None),
+            use_asyncio=settings['async_database'],
+            metrics=self.metrics,
+            pool_size=settings['postgres_pool_size'],
+            max_overflow=settings['postgres_max_overflow'],
+            pool_timeout=settings['postgres_pool_timeout'],
+            pool_recycle=settings['postgres_pool_recycle'],
+            pool_pre_ping=settings['postgres_pool_pre_ping'])
+
+        self.track_cache = TieredCache(
+            'track',
+            self.redis_pool,
+            size=settings['track_cache_size'],
+            metrics=self.metrics)
+        self.search_cache = TieredCache(
+            'search',
+            self.redis_pool,
+            size=settings['search_cache_size'],
+            ttl=settings['search_cache_ttl'],
+            metrics=self.metrics)
+        self.search_flight = SingleFlight()
+
+        # Shared services are handed to the controllers via session info
+        self.database.session_cls.configure(info={
+            'database': self.database,
+            'redis_pool': self.redis_pool,
+            'metrics': self.metrics,
+            'track_cache': self.track_cache,
+            'search_cache': self.search_cache,
+            'search_flight': self.search_flight})
 
         self.event_mapper = EventMapper(
             self.database,
             self.redis_pool)
 
+        self.listener = Listener()
+        self.multiplexer = Multiplexer(
+            self.redis_pool,
+            self.listener)
+
     def shutdown(self):
+        self.multiplexer.shutdown()
+        self.listener.shutdown()
         self.event_mapper.shutdown()
         self.database.shutdown()
         self.redis_pool.shutdown()
@@ -230,16 +319,138 @@ class RedisPool(redis.ConnectionPool):
         self.disconnect()
 
 
+class Session(orm.Session):
+    """Database session that can run its blocking work on an executor.
+
+    Without an executor the work is run inline on the calling thread.
+    With an executor the calls are run one after the other, so tasks
+    sharing a session never use it from two threads at once. Sessions
+    are not thread safe, any other use of them has to go through `run`.
+    """
+
+    def __init__(self, executor=None, **kw):
+        super().__init__(**kw)
+        self.executor = executor
+        self.lock = tornado.locks.Lock()
+
+    async def run(self, func, *args, **kw):
+        """Call `func` with the given arguments off the ioloop."""
+        if self.executor is None:
+            return func(*args, **kw)
+        async with self.lock:
+            ioloop = tornado.ioloop.IOLoop.current()
+            return await ioloop.run_in_executor(
+                self.executor, functools.partial(func, *args, **kw))
+
+
+class AsyncioSession(Session):
+    """Database session of the asyncio engine.
+
+    Its work is run through the `AsyncSession` wrapping it, which awaits
+    the database inside of a greenlet on the ioloop instead of a thread.
+    The calls are still run one after the other, since a session cannot
+    await two statements at once.
+    """
+
+    async_session = None
+
+    async def run(self, func, *args, **kw):
+        """Call `func` with the given arguments awaiting its statements."""
+        async with self.lock:
+            return await self.async_session.run_sync(
+                lambda _: func(*args, **kw))
+
+    def close(self):
+        # Connections of the asyncio engine are released with awaits
+        return tornado.gen.convert_yielded(self.run(super().close))
+
+
+class MeteredPool(sqlalchemy.pool.QueuePool):
+    """Connection pool that records how long checkouts wait in line."""
+
+    metrics = None
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super()._do_get()
+        finally:
+            if self.metrics:
+                self.metrics.histogram('database.pool.wait_ms').observe(
+                    1000.0 * (time.time() - start))
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+class MeteredAsyncPool(MeteredPool, sqlalchemy.pool.AsyncAdaptedQueuePool):
+    """Metered connection pool of the asyncio engine."""
+
+
 class Database(object):
-    """Postgres database session factory that insures initialization."""
+    """Postgres database session factory that insures initialization.
+
+    With `use_asyncio` the sessions are bound to an asyncpg engine and
+    await their work without threads, while the tables and providers are
+    still set up through a blocking engine without a pool.
+    """
 
-    def __init__(self, user, password, host, port, db):
+    def __init__(self, user, password, host, port, db, executor=None,
+                 metrics=None, use_asyncio=False, **pool_kw):
         self.address = '{}:{}/{}'.format(host, port, db)
-        uri = 'postgresql://{}:{}@{}'.format(user, password, self.address)
-        self.engine = sql.create_engine(uri, client_encoding='utf8')
-        self.session_cls = orm.sessionmaker(bind=self.engine)
+        credentials = '{}:{}@{}'.format(user, password, self.address)
+        if use_asyncio:
+            if create_async_engine is None:
+                raise ValueError('async database needs sqlalchemy[asyncio]')
+            self.engine = sql.create_engine(
+                'postgresql://' + credentials, client_encoding='utf8',
+                poolclass=sqlalchemy.pool.NullPool)
+            self.async_engine = create_async_engine(
+                'postgresql+asyncpg://' + credentials,
+                poolclass=MeteredAsyncPool, **pool_kw)
+            # Entities stay loaded after commits, refreshing them would
+            # await the database outside of the session
+            self.session_cls = orm.sessionmaker(
+                class_=AsyncioSession, expire_on_commit=False)
+            self.pool_engine = self.async_engine.sync_engine
+        else:
+            self.engine = sql.create_engine(
+                'postgresql://' + credentials, client_encoding='utf8',
+                poolclass=MeteredPool, **pool_kw)
+            self.async_engine = None
+            self.session_cls = orm.sessionmaker(
+                bind=self.engine, class_=Session, executor=executor)
+            self.pool_engine = self.engine
+        if metrics:
+            self.instrument(metrics)
         self.initialize()
 
+    def instrument(self, metrics):
+        """Report pool wait, checkout durations and pool usage."""
+        engine = self.pool_engine
+        engine.pool.metrics = metrics
+
+        def on_checkout(dbapi_connection, connection_record, proxy):
+            connection_record.info['checkout_time'] = time.time()
+
+        def on_checkin(dbapi_connection, connection_record):
+            start = connection_record.info.pop('checkout_time', None)
+            if start is not None:
+                metrics.histogram('database.pool.checkout_ms').observe(
+                    1000.0 * (time.time() - start))
+
+        event.listen(engine, 'checkout', on_checkout)
+        event.listen(engine, 'checkin', on_checkin)
+        metrics.gauge(
+            'database.pool.size', lambda: engine.pool.size())
+        metrics.gauge(
+            'database.pool.checked_out',
+            lambda: engine.pool.checkedout())
+        metrics.gauge(
+            'database.pool.overflow', lambda: engine.pool.overflow())
+
     def initialize(self):
         app_log.info('connecting to {}'.format(self.address))
         self.ensure_tables()
@@ -251,23 +462,42 @@ class Database(object):
 
     def populate_providers(self):
         from cloudplayer.api.model.provider import Provider
-        session = self.create_session()
+        session = Session(bind=self.engine)
+        client_ids = {}
         for provider_id in opt.options.providers:
-            if not session.query(Provider).get(provider_id):
+            entity = session.query(Provider).get(provider_id)
+            if not entity:
                 entity = Provider(id=provider_id)
                 session.add(entity)
+            client_ids[provider_id] = entity.client_id
         session.commit()
         session.close()
+        # Provider configuration is static, controllers read it from here
+        self.client_ids = types.MappingProxyType(client_ids)
 
     def create_session(self):
-        return self.session_cls()
+        if self.async_engine is None:
+            return self.session_cls()
+        async_session = AsyncSession(
+            self.async_engine, sync_session_class=self.session_cls)
+        session = async_session.sync_session
+        session.async_session = async_session
+        return session
 
     def shutdown(self):
         app_log.info('shutting down {}'.format(self.address))
         self.engine.pool.dispose()
+        if self.async_engine is not None:
+            self.async_engine.sync_engine.pool.dispose()
 
 
 class EventMapper(object):
+    """Publishes model changes to their pubsub channels.
+
+    Events are collected per session while flushing and published in a
+    single pipeline after the commit, changes that are rolled back are
+    never broadcasted.
+    """
 
     def __init__(self, database, redis_pool):
         self.database = database
@@ -285,37 +515,75 @@ class EventMapper(object):
             if not getattr(model, '__channel__', None):
                 continue
             for hook, method in self.hook_map.items():
-                func = functools.partial(
-                    model.event_hook,
-                    self.redis_pool,
-                    method)
+                func = functools.partial(model.event_hook, method)
                 event.listen(model, hook, func)
                 self.listeners.append((model, hook, func))
 
+        session_hooks = [
+            ('after_commit', self.publish),
+            ('after_rollback', self.discard)]
+        for hook, func in session_hooks:
+            event.listen(self.database.session_cls, hook, func)
+            self.listeners.append((self.database.session_cls, hook, func))
+
         app_log.info('registered {} listeners'.format(len(self.listeners)))
 
+    def publish(self, session):
+        events = session.info.pop('events', None)
+        if not events:
+            return
+        cache = redis.Redis(connection_pool=self.redis_pool)
+        pipeline = cache.pipeline(transaction=False)
+        for _, channel, message in events:
+            pipeline.publish(channel, message)
+
+        start = time.time()
+        try:
+            pipeline.execute()
+        except redis.exceptions.ConnectionError:
+            status_code = 503
+            host = '::1'
+        else:
+            status_code = 200
+            host = cache.connection_pool.connection_kwargs['host']
+
+        pub_time = 1000.0 * (time.time() - start)
+        for method, channel, _ in events:
+            app_log.info('{} REDIS {} {} ({}) {:.2f}ms'.format(
+                status_code, method.upper(), channel, host, pub_time))
+
+    def discard(self, session):
+        session.info.pop('events', None)
+
     def shutdown(self):
         app_log.info('removing {} listeners'.format(len(self.listeners)))
         for listener in self.listeners:
             event.remove(*listener)
 
 
-def configure_httpclient():
+def configure_httpclient(metrics=None):
     """Try to configure an async httpclient"""
     defaults = opt.options.group_dict('httpclient')
+    max_clients = opt.options.http_max_clients
     try:
         tornado.httpclient.AsyncHTTPClient.configure(
-            'tornado.curl_httpclient.CurlAsyncHTTPClient', defaults=defaults)
+            'cloudplayer.api.httpclient.CurlHTTPClient',
+            defaults=defaults,
+            max_clients=max_clients,
+            max_host_connections=opt.options.http_max_host_connections,
+            tcp_keepalive=opt.options.http_tcp_keepalive,
+            metrics=metrics)
     except ImportError:  # pragma: no cover
         app_log.warn('could not setup curl client, using simple http instead')
-        tornado.httpclient.AsyncHTTPClient.configure(None, defaults=defaults)
+        tornado.httpclient.AsyncHTTPClient.configure(
+            None, defaults=defaults, max_clients=max_clients)
 
 
 def main():  # pragma: no cover
     """Main tornado application entry point"""
     define_options()
-    configure_httpclient()
     app = Application()
+    configure_httpclient(app.metrics)
     app.listen(opt.options.port)
     app_log.info('server listening at 127.0.0.1:%s', opt.options.port)
     ioloop = tornado.ioloop.IOLoop.current()
@@ -0,0 +1,178 @@
+"""
+    cloudplayer.api.cache
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2018 by Nicolas Drebenstedt
+    :license: GPL-3.0, see LICENSE for details
+"""
+import collections
+import functools
+import json
+import threading
+import time
+
+import redis
+import redis.exceptions
+import tornado.gen
+import tornado.ioloop
+from tornado.log import app_log
+
+
+class LRUCache(object):
+    """Bounded in-process cache evicting the least recently used items.
+
+    Entries can carry a time to live in seconds after which they are
+    treated as missing. The cache is safe to use from worker threads.
+    """
+
+    def __init__(self, size=1024, ttl=None):
+        self._lock = threading.Lock()
+        self._items = collections.OrderedDict()
+        self.size = size
+        self.ttl = ttl
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._items[key]
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl is not None and ttl <= 0:
+            return
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._items[key] = (value, expires)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class TieredCache(object):
+    """Two-tier cache with an in-process LRU in front of Redis.
+
+    Values are stored as JSON in Redis under keys prefixed by `name` and
+    expire after their time to live. Local copies are kept for at most
+    `local_ttl` seconds, so that other processes catch up on changes.
+    Redis being unavailable degrades the cache to its local tier. The
+    blocking Redis calls run on the default executor of the ioloop.
+    """
+
+    def __init__(self, name, redis_pool, size=1024, ttl=3600,
+                 local_ttl=60, metrics=None):
+        self.name = name
+        self.redis_pool = redis_pool
+        self.local = LRUCache(size, ttl=local_ttl)
+        self.ttl = ttl
+        self.metrics = metrics
+
+    def key(self, key):
+        return '{}.{}'.format(self.name, key)
+
+    def count(self, hits, misses):
+        if self.metrics:
+            prefix = '{}.cache'.format(self.name)
+            self.metrics.counter(prefix + '.hits').increment(hits)
+            self.metrics.counter(prefix + '.misses').increment(misses)
+
+    async def redis(self, func, *args):
+        """Call `func` with a Redis client and `args` off the ioloop."""
+        cache = redis.Redis(connection_pool=self.redis_pool)
+        try:
+            return await tornado.ioloop.IOLoop.current().run_in_executor(
+                None, functools.partial(func, cache, *args))
+        except redis.exceptions.ConnectionError as error:
+            app_log.warning('{} cache unavailable: {}'.format(
+                self.name, error))
+
+    async def get(self, key):
+        found = await self.get_many([key])
+        return found.get(key)
+
+    async def get_many(self, keys):
+        """Look up `keys` and return a dict of the ones found."""
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.local.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+
+        if missing:
+            values = await self.redis(
+                redis.Redis.mget, [self.key(k) for k in missing]) or []
+            for key, value in zip(missing, values):
+                if value is not None:
+                    value = json.loads(value.decode('utf-8'))
+                    self.local.set(key, value)
+                    found[key] = value
+
+        self.count(len(found), len(keys) - len(found))
+        return found
+
+    async def set(self, key, value, ttl=None):
+        await self.set_many({key: value}, ttl=ttl)
+
+    async def set_many(self, items, ttl=None):
+        """Store the `items` dict in both tiers for `ttl` seconds."""
+        ttl = self.ttl if ttl is None else ttl
+        if not items or ttl <= 0:
+            return
+        local_ttl = ttl if self.local.ttl is None else min(
+            ttl, self.local.ttl)
+        for key, value in items.items():
+            self.local.set(key, value, ttl=local_ttl)
+        await self.redis(self._store, items, int(ttl))
+
+    def _store(self, cache, items, ttl):
+        pipeline = cache.pipeline(transaction=False)
+        for key, value in items.items():
+            pipeline.set(self.key(key), json.dumps(value), ex=ttl)
+        pipeline.execute()
+
+    async def delete(self, key):
+        self.local.delete(key)
+        await self.redis(redis.Redis.delete, self.key(key))
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key into a single one.
+
+    While a call for a key is in flight, further callers of that key
+    await the same future instead of starting their own call.
+    """
+
+    def __init__(self):
+        self.futures = {}
+
+    def do(self, key, func, *args, **kw):
+        """Return a future resolving to the result of `func` for `key`."""
+        if key not in self.futures:
+            future = tornado.gen.convert_yielded(func(*args, **kw))
+            self.futures[key] = future
+            future.add_done_callback(
+                lambda _: self.futures.pop(key, None))
+        return self.futures[key]
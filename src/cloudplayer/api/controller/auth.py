@@ -6,28 +6,43 @@
     :license: GPL-3.0, see LICENSE for details
 """
 import datetime
+import functools
 import hashlib
+import time
 import urllib
+import uuid
 
 from tornado.log import app_log
+import redis
 import tornado.escape
 import tornado.gen
 import tornado.httpclient
 import tornado.httputil
+import tornado.ioloop
 import tornado.options as opt
 import tornado.web
 
+from cloudplayer.api.cache import SingleFlight
 from cloudplayer.api.controller import ControllerException, ProviderRegistry
 from cloudplayer.api.model.account import Account
 from cloudplayer.api.model.favourite import Favourite
 from cloudplayer.api.model.image import Image
-from cloudplayer.api.model.provider import Provider
-
-from sqlalchemy.orm.session import make_transient_to_detached
 
 
 class AuthController(object, metaclass=ProviderRegistry):
 
+    REFRESH_FLIGHT = SingleFlight()
+    RELOAD_FLIGHT = SingleFlight()
+    REFRESH_LOCK_TIMEOUT = 30
+    REFRESH_POLL_INTERVAL = 0.1
+    # Releases the refresh lock only if it is still held by the caller
+    REFRESH_RELEASE_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+        return 0
+    """
+
     def __init__(self, db, current_user=None, pubsub=None):
         self.db = db
         self.pubsub = pubsub
@@ -41,11 +56,105 @@ class AuthController(object, metaclass=ProviderRegistry):
                 keys = (id, self.__provider__)
                 self.account = self.db.query(Account).get(keys)
 
+    @property
+    def client_id(self):
+        database = self.db.info.get('database')
+        if database is not None:
+            return database.client_ids.get(self.__provider__)
+        return opt.options[self.__provider__]['api_key']
+
     @property
     def _should_refresh(self):
         now = datetime.datetime.utcnow()
         return self.account.token_expiration - now < datetime.timedelta(0)
 
+    @property
+    def _should_prefetch(self):
+        if self.account.token_expiration is None:
+            return False
+        now = datetime.datetime.utcnow()
+        margin = datetime.timedelta(seconds=opt.options.token_refresh_margin)
+        return self.account.token_expiration - now < margin
+
+    @property
+    def _refresh_key(self):
+        return 'refresh.{}.{}'.format(self.__provider__, self.account.id)
+
+    async def refresh_access(self):
+        """Refresh the access token of the account at most once at a time.
+
+        Concurrent refreshes of an account in this process await the same
+        refresh. Followers sharing the account object of the refresh are
+        up to date, the ones of other sessions reload their account once.
+        """
+        key = self._refresh_key
+        account = await self.REFRESH_FLIGHT.do(
+            key, self._refresh_access_locked)
+        if account is not self.account:
+            await self.RELOAD_FLIGHT.do(
+                (key, id(self.account)),
+                self.db.run, self.db.refresh, self.account)
+
+    async def _refresh_access_locked(self):
+        redis_pool = self.db.info.get('redis_pool')
+        if redis_pool is None:
+            await self._refresh_access()
+            return self.account
+        # A short lived lock keeps other processes from refreshing too
+        cache = redis.Redis(connection_pool=redis_pool)
+        key = self._refresh_key
+        token = uuid.uuid4().hex
+        locked = await self._offload(
+            cache.set, key, token, nx=True, ex=self.REFRESH_LOCK_TIMEOUT)
+        if not locked:
+            deadline = time.time() + self.REFRESH_LOCK_TIMEOUT
+            while time.time() < deadline:
+                if not await self._offload(cache.exists, key):
+                    break
+                await tornado.gen.sleep(self.REFRESH_POLL_INTERVAL)
+            await self.db.run(self.db.refresh, self.account)
+            if not self._should_refresh:
+                return self.account
+            # The other refresh failed or timed out
+            locked = await self._offload(
+                cache.set, key, token, nx=True, ex=self.REFRESH_LOCK_TIMEOUT)
+        try:
+            await self._refresh_access()
+        finally:
+            if locked:
+                await self._offload(
+                    cache.eval, self.REFRESH_RELEASE_SCRIPT, 1, key, token)
+        return self.account
+
+    @staticmethod
+    async def _offload(func, *args, **kw):
+        """Run a blocking redis call on the default executor."""
+        return await tornado.ioloop.IOLoop.current().run_in_executor(
+            None, functools.partial(func, *args, **kw))
+
+    def schedule_refresh(self):
+        """Refresh the access token in the background using a new session."""
+        database = self.db.info.get('database')
+        if database is None:
+            return
+        if self._refresh_key in self.REFRESH_FLIGHT.futures:
+            return
+        keys = (self.account.id, self.account.provider_id)
+
+        async def refresh():
+            db = database.create_session()
+            try:
+                controller = type(self)(db)
+                controller.account = await db.run(db.query(Account).get, keys)
+                if controller.account and controller._should_prefetch:
+                    await controller.refresh_access()
+            except Exception as error:
+                app_log.warning('background refresh failed: {}'.format(error))
+            finally:
+                db.close()
+
+        tornado.ioloop.IOLoop.current().spawn_callback(refresh)
+
     async def _refresh_access(self):
         body = urllib.parse.urlencode({
             'client_id': self.settings['key'],
@@ -60,10 +169,10 @@ class AuthController(object, metaclass=ProviderRegistry):
             message = response.body.decode('utf-8')
             raise ControllerException(403, message)
         access_info = tornado.escape.json_decode(response.body)
-
-        self._update_access_info(access_info)
-        self.db.add(self.account)
-        self.db.commit()
+        await self.db.run(self._store_access_info, access_info)
+        metrics = self.db.info.get('metrics')
+        if metrics:
+            metrics.counter('auth.refreshes').increment()
 
     async def fetch_async(self, request, **kw):
         try:
@@ -84,19 +193,15 @@ class AuthController(object, metaclass=ProviderRegistry):
 
         if self.account:
             if self._should_refresh:
-                await self._refresh_access()
+                await self.refresh_access()
+            elif self._should_prefetch:
+                self.schedule_refresh()
 
             if self.account.access_token:
                 params.append(
                     (self.OAUTH_TOKEN_PARAM, self.account.access_token))
-            provider = self.account.provider
-        else:
-            provider = Provider()
-            provider.id = self.__provider__
-            make_transient_to_detached(provider)
-            provider = self.db.merge(provider, load=False)
 
-        params.append((self.OAUTH_CLIENT_KEY, provider.client_id))
+        params.append((self.OAUTH_CLIENT_KEY, self.client_id))
 
         url = '{}/{}'.format(self.API_BASE_URL, path.lstrip('/'))
         uri = tornado.httputil.url_concat(url, params)
@@ -122,6 +227,11 @@ class AuthController(object, metaclass=ProviderRegistry):
             self.account.token_expiration = datetime.datetime.utcnow() + (
                 datetime.timedelta(seconds=access_info['expires_in']))
 
+    def _store_access_info(self, access_info):
+        self._update_access_info(access_info)
+        self.db.add(self.account)
+        self.db.commit()
+
     def _update_account_profile(self, account_info):
         raise NotImplementedError()  # pragma: no cover
 
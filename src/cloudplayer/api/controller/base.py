@@ -5,11 +5,18 @@
     :copyright: (c) 2018 by Nicolas Drebenstedt
     :license: GPL-3.0, see LICENSE for details
 """
+import base64
+import itertools
+import json
+
+import sqlalchemy
 import sqlalchemy.exc
+import tornado.options as opt
 from tornado.log import app_log
 
 from cloudplayer.api import APIException
 from cloudplayer.api.access import Available, Policy
+from cloudplayer.api.model import serialize
 
 
 class ControllerException(APIException):
@@ -18,6 +25,31 @@ class ControllerException(APIException):
         super().__init__(status_code, log_message)
 
 
+class Page(list):
+    """List of entities knowing the cursor of the page following it."""
+
+    def __init__(self, entities=(), cursor=None):
+        super().__init__(entities)
+        self.cursor = cursor
+
+
+def encode_cursor(values):
+    """Encode the sort key of an entity into an opaque cursor."""
+    return base64.urlsafe_b64encode(serialize(values)).decode('ascii')
+
+
+def decode_cursor(cursor, length):
+    """Decode a cursor into a sort key with `length` values."""
+    try:
+        values = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except ValueError:
+        raise ControllerException(400, 'invalid cursor')
+    if not isinstance(values, list) or len(values) != length:
+        raise ControllerException(400, 'invalid cursor')
+    return values
+
+
 class ProviderRegistry(type):
     """Metaclass for controllers that registers provider specific
     implementations on the generic controller under the provider ID.
@@ -53,9 +85,14 @@ class Controller(object, metaclass=ProviderRegistry):
 
     Implementations provide a model class attribute that allow CRUD methods
     to dynamically adapt to the models field an ACL definitions.
+
+    Implementations that name a unique sort key of their model as cursor
+    return searches in pages, which are continued after the sort key of
+    their last entity.
     """
 
     __model__ = None
+    __cursor__ = None
 
     def __init__(self, db, current_user=None, pubsub=None):
         self.db = db
@@ -73,6 +110,23 @@ class Controller(object, metaclass=ProviderRegistry):
             params[field] = value
         return params
 
+    def _eject_page_from_kw(self, kw):
+        params = kw.copy()
+        if 'limit' not in params and 'after' not in params:
+            # Clients that do not page get the whole result as before
+            return params, None
+        after = params.pop('after', None)
+        if after is not None:
+            after = decode_cursor(after, len(self.__cursor__))
+        max_page_size = opt.options.max_page_size
+        try:
+            limit = int(params.pop('limit', max_page_size))
+        except ValueError:
+            raise ControllerException(400, 'invalid limit')
+        if limit < 1:
+            raise ControllerException(400, 'invalid limit')
+        return params, (after, min(limit, max_page_size))
+
     @staticmethod
     def _eject_ids_from_kw(ids, kw):
         params = kw.copy()
@@ -86,12 +140,28 @@ class Controller(object, metaclass=ProviderRegistry):
                         400, 'mismatch on {}'.format(field))
         return params
 
+    def get_auth_controller(self, provider_id):
+        """Return the auth controller holding the upstream credentials.
+
+        Auth controllers are kept on the session info, so that all
+        controllers of a request share the credentials looked up once.
+        """
+        from cloudplayer.api.controller.auth import AuthController
+        credentials = self.db.info.setdefault('credentials', {})
+        key = (provider_id, tuple(sorted((self.current_user or {}).items())))
+        if key in credentials:
+            metrics = self.db.info.get('metrics')
+            if metrics and (self.current_user or {}).get(provider_id):
+                metrics.counter('auth.lookups_saved').increment()
+        else:
+            credentials[key] = AuthController.for_provider(
+                provider_id, self.db, self.current_user)
+        return credentials[key]
+
     async def fetch(self, provider_id, path, params=None, **kw):
         """Convenience method for fetching from an upstream provider."""
-        # TODO: Can authed fetching be generalized?
-        from cloudplayer.api.controller.auth import AuthController
-        controller = AuthController.for_provider(
-            provider_id, self.db, self.current_user)
+        # Creating an auth controller looks up the account of the user
+        controller = await self.db.run(self.get_auth_controller, provider_id)
         response = await controller.fetch(path, params=params, **kw)
         return response
 
@@ -106,7 +176,17 @@ class Controller(object, metaclass=ProviderRegistry):
             self._accounts[provider_id] = account
         return self._accounts[provider_id]
 
+    async def load_account(self, provider_id):
+        """Look up the account like `get_account` but off the ioloop."""
+        accounts = getattr(self, '_accounts', {})
+        if provider_id in accounts:
+            return accounts[provider_id]
+        return await self.db.run(self.get_account, provider_id)
+
     async def create(self, ids, kw, fields=Available):
+        return await self.db.run(self._create, ids, kw, fields)
+
+    def _create(self, ids, kw, fields):
         provider_id = ids.get('provider_id', 'cloudplayer')
         account = self.get_account(provider_id)
 
@@ -130,6 +210,9 @@ class Controller(object, metaclass=ProviderRegistry):
         return entity
 
     async def read(self, ids, fields=Available):
+        return await self.db.run(self._read, ids, fields)
+
+    def _read(self, ids, fields):
         entity = self.db.query(self.__model__).filter_by(**ids).first()
         if not entity:
             raise ControllerException(404, 'entity not found')
@@ -138,6 +221,9 @@ class Controller(object, metaclass=ProviderRegistry):
         return entity
 
     async def update(self, ids, kw, fields=Available):
+        return await self.db.run(self._update, ids, kw, fields)
+
+    def _update(self, ids, kw, fields):
         entity = self.db.query(self.__model__).filter_by(**ids).first()
         if not entity:
             raise ControllerException(404, 'updatable not found')
@@ -151,6 +237,9 @@ class Controller(object, metaclass=ProviderRegistry):
         return entity
 
     async def delete(self, ids):
+        await self.db.run(self._delete, ids)
+
+    def _delete(self, ids):
         entity = self.db.query(self.__model__).filter_by(**ids).first()
         if not entity:
             raise ControllerException(404, 'deletable not found')
@@ -160,6 +249,9 @@ class Controller(object, metaclass=ProviderRegistry):
         self.db.commit()
 
     async def query(self, ids, kw):
+        return await self.db.run(self._query, ids, kw)
+
+    def _query(self, ids, kw):
         provider_id = ids.get('provider_id', 'cloudplayer')
         account = self.get_account(provider_id)
         if 'account_id' in kw:
@@ -173,14 +265,69 @@ class Controller(object, metaclass=ProviderRegistry):
         return query
 
     async def search(self, ids, kw, fields=Available):
+        page = None
+        if self.__cursor__:
+            kw, page = self._eject_page_from_kw(kw)
         query = await self.query(ids, kw)
-        entities = query.all()
         provider_id = ids.get('provider_id', 'cloudplayer')
+        return await self.db.run(
+            self._search, query, provider_id, fields, page)
+
+    def _search(self, query, provider_id, fields, page=None):
+        if page:
+            entities = self._paginate(query, *page)
+        else:
+            entities = query.all()
         account = self.get_account(provider_id)
         self.policy.grant_read(account, entities, fields)
         return entities
 
+    def _paginate(self, query, after, limit):
+        columns = [getattr(self.__model__, c) for c in self.__cursor__]
+        query = query.order_by(None).order_by(*columns)
+        if after is not None:
+            values = [sqlalchemy.literal(v, type_=c.type)
+                      for c, v in zip(columns, after)]
+            query = query.filter(
+                sqlalchemy.tuple_(*columns) > sqlalchemy.tuple_(*values))
+        entities = query.limit(limit + 1).all()
+        if len(entities) <= limit:
+            return Page(entities)
+        entities = entities[:limit]
+        cursor = encode_cursor(
+            [getattr(entities[-1], c) for c in self.__cursor__])
+        return Page(entities, cursor)
+
+    async def stream(self, ids, kw, fields=Available):
+        """Search entities and yield them in batches.
+
+        Rows are read through a server side cursor and granted batch by
+        batch, so that at most `stream_batch_size` entities are loaded
+        at a time, regardless of the size of the result.
+        """
+        query = await self.query(ids, kw)
+        provider_id = ids.get('provider_id', 'cloudplayer')
+        size = opt.options.stream_batch_size
+        rows = await self.db.run(iter, query.yield_per(size))
+        while True:
+            batch = await self.db.run(
+                self._stream, rows, size, provider_id, fields)
+            if not batch:
+                break
+            yield batch
+
+    def _stream(self, rows, size, provider_id, fields):
+        batch = list(itertools.islice(rows, size))
+        if batch:
+            account = self.get_account(provider_id)
+            self.policy.grant_read(account, batch, fields)
+        return batch
+
     async def sub(self, ids, registry):
+        await self.db.run(self._sub, ids)
+        self.pubsub.subscribe(**registry)
+
+    def _sub(self, ids):
         provider_id = ids.get('provider_id', 'cloudplayer')
         account = self.get_account(provider_id)
         kw = {}
@@ -189,8 +336,7 @@ class Controller(object, metaclass=ProviderRegistry):
             kw.setdefault('account_provider_id', account.provider_id)
         params = self._merge_ids_with_kw(ids, kw)
         self.policy.grant_query(account, self.__model__, params)
-        self.pubsub.subscribe(**registry)
 
     async def unsub(self, ids, registry):
         for channel in registry:
-            self.pubsub.subscribe(channel)
+            self.pubsub.unsubscribe(channel)
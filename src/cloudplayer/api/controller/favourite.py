@@ -5,7 +5,6 @@
     :copyright: (c) 2018 by Nicolas Drebenstedt
     :license: GPL-3.0, see LICENSE for details
 """
-from cloudplayer.api.access import Available
 from cloudplayer.api.controller import Controller
 from cloudplayer.api.model.favourite import Favourite
 
@@ -14,9 +13,9 @@ class FavouriteController(Controller):
 
     __model__ = Favourite
 
-    async def read(self, ids, fields=Available):
+    def _read(self, ids, fields):
         if ids['id'] == 'mine':
             account = self.get_account(ids['provider_id'])
             if account:
                 ids['id'] = account.favourite.id
-        return await super().read(ids, fields=fields)
+        return super()._read(ids, fields)
@@ -14,18 +14,21 @@ from cloudplayer.api.model.favourite_item import FavouriteItem
 class FavouriteItemController(Controller):
 
     __model__ = FavouriteItem
+    __cursor__ = ('created', 'id')
 
 
 class CloudplayerFavouriteItemController(Controller):
 
     __provider__ = 'cloudplayer'
     __model__ = FavouriteItem
+    __cursor__ = ('created', 'id')
 
 
 class SoundcloudFavouriteItemController(Controller):
 
     __provider__ = 'soundcloud'
     __model__ = FavouriteItem
+    __cursor__ = ('created', 'id')
 
 
 class YoutubeFavouriteItemController(Controller):
@@ -18,17 +18,20 @@ class PlaylistController(Controller):
 
     async def read(self, ids, fields=Available):
         if ids['id'] == 'random':
-            provider_id = ids['provider_id']
-            account = self.get_account(provider_id)
-            kw = dict(
-                account_id=account.id,
-                account_provider_id=account.provider_id,
-                provider_id=provider_id)
-            self.policy.grant_query(account, self.__model__, kw)
-            ids = dict(
-                provider_id=provider_id)
-            query = await self.query(ids, kw)
-            random = query.order_by(func.random()).first()
-            if random:
-                ids['id'] = random.id
+            ids = await self.db.run(self._random, ids['provider_id'])
         return await super().read(ids, fields=fields)
+
+    def _random(self, provider_id):
+        account = self.get_account(provider_id)
+        kw = dict(
+            account_id=account.id,
+            account_provider_id=account.provider_id,
+            provider_id=provider_id)
+        self.policy.grant_query(account, self.__model__, kw)
+        ids = dict(
+            provider_id=provider_id)
+        query = self._query(ids, kw)
+        random = query.order_by(func.random()).first()
+        if random:
+            ids['id'] = random.id
+        return ids
@@ -5,16 +5,35 @@
     :copyright: (c) 2018 by Nicolas Drebenstedt
     :license: GPL-3.0, see LICENSE for details
 """
+import tornado.ioloop
+import tornado.options as opt
+from tornado.log import app_log
+
 from cloudplayer.api.access import Available
+from cloudplayer.api.cache import SingleFlight
 from cloudplayer.api.controller import Controller, ControllerException
 from cloudplayer.api.controller.track import TrackController
 from cloudplayer.api.model.playlist import Playlist
 from cloudplayer.api.model.playlist_item import PlaylistItem
+from cloudplayer.api.util import rank_between, rank_range
 
 
 class PlaylistItemController(Controller):
+    """Controller for playlist items ordered by fractional ranks.
+
+    Items are placed `before` or `after` other items of their playlist,
+    which only writes the rank of the placed item. Ranks that grew long
+    from repeated placements trigger a rebalance of the playlist in the
+    background. Ranks that would not fit the rank column any more are
+    rebalanced before the placement. Placements are granted before they
+    lock the playlist and rebalances are only scheduled after commits.
+    """
 
     __model__ = PlaylistItem
+    __cursor__ = ('rank', 'id')
+
+    MAX_RANK_LENGTH = PlaylistItem.__table__.c.rank.type.length
+    REBALANCE_FLIGHT = SingleFlight()
 
     async def create(self, ids, kw, fields=Available):
         track_id = kw.get('track_id')
@@ -26,16 +45,156 @@ class PlaylistItemController(Controller):
         if not track:
             raise ControllerException(404, 'track not found')
 
-        playlist = self.db.query(Playlist).get(
-            (ids.pop('playlist_id'), ids.pop('playlist_provider_id')))
+        playlist_ids = (
+            ids.pop('playlist_id'), ids.pop('playlist_provider_id'))
+        entity, rebalance = await self.db.run(
+            self._create_item, playlist_ids, track, ids, kw, fields)
+        if rebalance:
+            self.schedule_rebalance(rebalance)
+        return entity
+
+    async def update(self, ids, kw, fields=Available):
+        if 'before' not in kw and 'after' not in kw:
+            return await super().update(ids, kw, fields=fields)
+        entity, rebalance = await self.db.run(
+            self._move_item, ids, kw, fields)
+        if rebalance:
+            self.schedule_rebalance(rebalance)
+        return entity
+
+    def _create_item(self, playlist_ids, track, ids, kw, fields):
+        """Create the item placed in its playlist once it was granted.
+
+        Returns the item along with the playlist ids to rebalance after
+        the commit, if any.
+        """
+        playlist = self.db.query(Playlist).get(playlist_ids)
         if not playlist:
             raise ControllerException(404, 'playlist not found')
+        # Placing locks the playlist, which is reserved to its owner
+        template = PlaylistItem(
+            playlist_id=playlist.id,
+            playlist_provider_id=playlist.provider_id)
+        self.db.enable_relationship_loading(template)
+        account = self.get_account(ids.get('provider_id', 'cloudplayer'))
+        self.policy.grant_create(account, template, ['rank'])
 
         if not playlist.image:
             playlist.image = track.image.copy()
             self.db.add(playlist)
+        params, rebalance = self._place(playlist_ids, kw)
+        entity = self._create(ids, params, fields)
+        return entity, playlist_ids if rebalance else None
+
+    def _move_item(self, ids, kw, fields):
+        """Move the item in its playlist once it was granted."""
+        entity = self.db.query(PlaylistItem).filter_by(**ids).first()
+        if not entity:
+            raise ControllerException(404, 'updatable not found')
+        # Placing locks the playlist, which is reserved to its owner
+        account = self.get_account(entity.provider_id)
+        self.policy.grant_update(account, entity, ['rank'])
+
+        playlist_ids = (entity.playlist_id, entity.playlist_provider_id)
+        params, rebalance = self._place(playlist_ids, kw, entity.id)
+        entity = self._update(ids, params, fields)
+        return entity, playlist_ids if rebalance else None
+
+    def _lock(self, playlist_ids):
+        # Placements and rebalances of a playlist wait for each other
+        playlist_id, playlist_provider_id = playlist_ids
+        self.db.query(Playlist.id).filter_by(
+            id=playlist_id,
+            provider_id=playlist_provider_id).with_for_update().first()
+        return self.db.query(PlaylistItem).filter_by(
+            playlist_id=playlist_id,
+            playlist_provider_id=playlist_provider_id)
+
+    def _place(self, playlist_ids, kw, item_id=None, retry=True):
+        """Replace the `before` and `after` item ids in `kw` with a rank.
+
+        Items without rank or position are appended to the playlist.
+        Returns the parameters along with whether the new rank is long
+        enough to rebalance the playlist in the background.
+        """
+        params = kw.copy()
+        before = params.pop('before', None)
+        after = params.pop('after', None)
+        if before is None and after is None and 'rank' in params:
+            return params, False
+
+        items = self._lock(playlist_ids)
+        if item_id is not None:
+            items = items.filter(PlaylistItem.id != item_id)
+        ranks = items.with_entities(PlaylistItem.rank)
+
+        def rank_of(neighbour_id):
+            rank = ranks.filter(PlaylistItem.id == neighbour_id).scalar()
+            if rank is None:
+                raise ControllerException(404, 'neighbour not found')
+            return rank
+
+        lower = upper = None
+        if after is not None:
+            lower = rank_of(after)
+        if before is not None:
+            upper = rank_of(before)
+        if before is None and after is None:
+            lower = ranks.order_by(PlaylistItem.rank.desc()).limit(1).scalar()
+        elif before is None:
+            upper = ranks.filter(PlaylistItem.rank > lower).order_by(
+                PlaylistItem.rank).limit(1).scalar()
+        elif after is None:
+            lower = ranks.filter(PlaylistItem.rank < upper).order_by(
+                PlaylistItem.rank.desc()).limit(1).scalar()
+
+        try:
+            rank = rank_between(lower, upper)
+        except ValueError:
+            rank = None
+        if rank is None or len(rank) > self.MAX_RANK_LENGTH:
+            if not retry:
+                raise ControllerException(400, 'invalid position')
+            # Foreign and overlong ranks are replaced before placing
+            self._rebalance(playlist_ids)
+            return self._place(playlist_ids, kw, item_id, retry=False)
+
+        params['rank'] = rank
+        return params, len(rank) > opt.options.rank_rebalance_length
+
+    def _rebalance(self, playlist_ids):
+        items = self._lock(playlist_ids).order_by(
+            PlaylistItem.rank, PlaylistItem.id).all()
+        for item, rank in zip(items, rank_range(len(items))):
+            if item.rank != rank:
+                item.rank = rank
+        self.db.flush()
+
+    def schedule_rebalance(self, playlist_ids):
+        """Rebalance the ranks of a playlist in the background.
+
+        Must be called on the IOLoop thread, not from within `db.run`.
+        """
+        database = self.db.info.get('database')
+        if database is None:
+            return
+        if playlist_ids in self.REBALANCE_FLIGHT.futures:
+            return
+
+        async def rebalance():
+            db = database.create_session()
+            try:
+                controller = type(self)(db, self.current_user)
+                await db.run(controller._rebalance, playlist_ids)
+                await db.run(db.commit)
+            except Exception as error:
+                app_log.warning('background rebalance failed: {}'.format(
+                    error))
+            finally:
+                db.close()
 
-        return await super().create(ids, kw, fields=fields)
+        tornado.ioloop.IOLoop.current().add_callback(
+            self.REBALANCE_FLIGHT.do, playlist_ids, rebalance)
 
     async def query(self, ids, kw):
         query = await super().query(ids, kw)
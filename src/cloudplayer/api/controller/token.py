@@ -16,7 +16,7 @@ class TokenController(Controller):
 
     __model__ = Token
 
-    async def read(self, ids, fields=Available):
+    def _read(self, ids, fields):
         threshold = datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
         query = self.db.query(
             self.__model__).filter_by(**ids).filter(Token.created > threshold)
@@ -5,40 +5,161 @@
     :copyright: (c) 2018 by Nicolas Drebenstedt
     :license: GPL-3.0, see LICENSE for details
 """
+import collections
 import datetime
 import itertools
 import random
+import time
 import traceback
 import urllib.parse
 
 import tornado.escape
 import tornado.gen
+import tornado.ioloop
+import tornado.locks
 import tornado.options as opt
+from tornado.log import app_log
 
 from cloudplayer.api.access import Available
 from cloudplayer.api.controller import Controller, ControllerException
 from cloudplayer.api.model.track import Track
-from cloudplayer.api.util import chunk_range, squeeze
+from cloudplayer.api.util import squeeze
+
+
+class SearchResult(list):
+    """List of tracks that remembers which providers did not answer."""
+
+    def __init__(self, tracks=(), missing=()):
+        super().__init__(tracks)
+        self.missing = list(missing)
 
 
 class TrackController(Controller):
 
     MAX_RESULTS = 50
 
-    async def search(self, ids, kw, fields=Available):
-        futures = []
+    async def cached_tracks(self, provider_id, track_ids):
+        """Look up raw provider tracks by id in the track cache."""
+        track_cache = self.db.info.get('track_cache')
+        if not track_cache:
+            return {}
+        keys = ['{}.{}'.format(provider_id, i) for i in track_ids]
+        found = await track_cache.get_many(keys)
+        return {i: found[k] for i, k in zip(track_ids, keys) if k in found}
+
+    async def cache_tracks(self, provider_id, tracks):
+        """Store raw provider tracks in the track cache."""
+        track_cache = self.db.info.get('track_cache')
+        if not track_cache:
+            return
+        ttl = opt.options.track_cache_ttl.get(provider_id)
+        await track_cache.set_many({
+            '{}.{}'.format(provider_id, t['id']): t for t in tracks}, ttl=ttl)
+
+    @staticmethod
+    def search_key(provider_id, kw, account_id=None):
+        """Normalize search arguments into a cache key.
+
+        Searches are fetched with the credentials of the account, so
+        their results are only shared between requests of the same
+        account or between anonymous ones.
+        """
+        query = ' '.join((kw.get('q') or '').lower().split())
+        duration = kw.get('duration')
+        if duration not in ('long', 'medium', 'short'):
+            duration = 'any'
+        scope = 'anonymous' if account_id is None else account_id
+        return '{}.{}.{}.{}'.format(provider_id, scope, duration, query)
+
+    async def cached_search(self, provider_id, kw, fetch):
+        """Return the raw search result `fetch` produces for `kw`.
+
+        Results are cached and concurrent identical searches of the
+        same account share a single upstream request.
+        """
+        account_id = (self.current_user or {}).get(provider_id)
+        key = self.search_key(provider_id, kw, account_id)
+        search_cache = self.db.info.get('search_cache')
+        if search_cache:
+            result = await search_cache.get(key)
+            if result is not None:
+                return result
+
+        async def fill():
+            result = await fetch()
+            if search_cache:
+                await search_cache.set(key, result)
+            return result
+
+        search_flight = self.db.info.get('search_flight')
+        if search_flight:
+            return await search_flight.do(key, fill)
+        return await fill()
+
+    async def search_provider(self, provider_id, kw, fields=Available):
+        """Search a single provider and record its latency.
+
+        Failures are logged and reported as `None` so that a single
+        provider cannot fail the aggregated search. Every provider is
+        searched in a session of its own, which stays usable when the
+        search outlives the request that started it.
+        """
+        database = self.db.info.get('database')
+        db = database.create_session() if database else self.db
+        controller = self.for_provider(provider_id, db, self.current_user)
+        local_ids = kw.copy()
+        local_ids['provider_id'] = provider_id
+        start = time.time()
+        try:
+            return await controller.search(local_ids, kw, fields=fields)
+        except Exception as error:
+            app_log.warning('{} search failed: {}'.format(provider_id, error))
+        finally:
+            metrics = self.db.info.get('metrics')
+            if metrics:
+                metrics.histogram('track.search.{}_ms'.format(
+                    provider_id)).observe(1000.0 * (time.time() - start))
+            if db is not self.db:
+                db.close()
+
+    async def aggregate(self, kw, fields=Available):
+        """Yield `(provider_id, tracks)` as the providers answer.
+
+        Providers that fail or do not answer within `search_budget`
+        seconds are yielded last with `None` instead of their tracks.
+        Late searches are left to finish in their own sessions, so that
+        their results still reach the search cache.
+        """
+        futures = {}
         for provider_id in opt.options.providers:
+            if provider_id in self.__registry__:
+                futures[provider_id] = tornado.gen.convert_yielded(
+                    self.search_provider(provider_id, kw, fields=fields))
+        pending = set(futures)
+        deadline = (tornado.ioloop.IOLoop.current().time() +
+                    opt.options.search_budget)
+        wait_iterator = tornado.gen.WaitIterator(**futures)
+        while not wait_iterator.done():
             try:
-                controller = self.for_provider(
-                    provider_id, self.db, self.current_user)
-            except ValueError:
-                continue
-            local_ids = kw.copy()
-            local_ids['provider_id'] = provider_id
-            future = controller.search(local_ids, kw, fields=fields)
-            futures.append(future)
-        entities = await tornado.gen.multi(futures)
-        tracks = list(itertools.chain(*entities))
+                tracks = await tornado.gen.with_timeout(
+                    deadline, wait_iterator.next())
+            except tornado.gen.TimeoutError:
+                break
+            provider_id = wait_iterator.current_index
+            if tracks is not None:
+                pending.discard(provider_id)
+                yield provider_id, tracks
+        for provider_id in opt.options.providers:
+            if provider_id in pending:
+                yield provider_id, None
+
+    async def search(self, ids, kw, fields=Available):
+        tracks = SearchResult()
+        async for provider_id, entities in self.aggregate(kw, fields):
+            if entities is None:
+                tracks.missing.append(provider_id)
+            else:
+                tracks.extend(entities)
         random.Random(kw.get('q', '')).shuffle(tracks)
         return tracks
 
@@ -66,11 +187,16 @@ class SoundcloudTrackController(TrackController):
     }
 
     async def read(self, ids, fields=Available):
-        response = await self.fetch(
-            ids['provider_id'], '/tracks/{}'.format(ids['id']))
-        track = tornado.escape.json_decode(response.body)
+        cached = await self.cached_tracks(ids['provider_id'], [ids['id']])
+        if ids['id'] in cached:
+            track = cached[ids['id']]
+        else:
+            response = await self.fetch(
+                ids['provider_id'], '/tracks/{}'.format(ids['id']))
+            track = tornado.escape.json_decode(response.body)
+            await self.cache_tracks(ids['provider_id'], [track])
         entity = Track.from_soundcloud(track)
-        account = self.get_account(entity.provider_id)
+        account = await self.load_account(entity.provider_id)
         self.policy.grant_read(account, entity, fields)
         return entity
 
@@ -82,11 +208,17 @@ class SoundcloudTrackController(TrackController):
         if 'duration' in kw:
             duration = self.SEARCH_DURATION.get(kw['duration'], {})
             params.update(duration.copy())
-        response = await self.fetch(
-            ids['provider_id'], '/tracks', params=params)
-        track_list = tornado.escape.json_decode(response.body)
+
+        async def fetch():
+            response = await self.fetch(
+                ids['provider_id'], '/tracks', params=params)
+            track_list = tornado.escape.json_decode(response.body)
+            await self.cache_tracks(ids['provider_id'], track_list)
+            return track_list
+
+        track_list = await self.cached_search(ids['provider_id'], kw, fetch)
         entities = []
-        account = self.get_account(ids['provider_id'])
+        account = await self.load_account(ids['provider_id'])
         for track in track_list:
             try:
                 entity = Track.from_soundcloud(track)
@@ -102,6 +234,8 @@ class YoutubeTrackController(TrackController):
 
     __provider__ = 'youtube'
 
+    MAX_IDS = 50
+
     MREAD_FIELDS = squeeze("""
         items(
         id,
@@ -133,25 +267,58 @@ class YoutubeTrackController(TrackController):
         if entities:
             return entities[0]
 
+    VIDEO_PARAMS = {
+        'part': 'snippet,contentDetails,player,statistics',
+        'fields': MREAD_FIELDS,
+        'maxWidth': '320'}
+
+    async def hydrate(self, provider_id, track_ids):
+        """Resolve `track_ids` into raw tracks in the requested order.
+
+        Cached tracks are taken from the track cache, the remaining ids
+        are packed into batches of `MAX_IDS` which are fetched with at
+        most `hydrate_concurrency` requests in flight.
+        """
+        track_ids = list(collections.OrderedDict.fromkeys(track_ids))
+        tracks = await self.cached_tracks(provider_id, track_ids)
+        missing = [i for i in track_ids if i not in tracks]
+        semaphore = tornado.locks.Semaphore(opt.options.hydrate_concurrency)
+
+        async def fetch_batch(batch):
+            params = dict(self.VIDEO_PARAMS)
+            params['id'] = ','.join(
+                urllib.parse.quote(i, safe='') for i in batch)
+            async with semaphore:
+                response = await self.fetch(
+                    provider_id, '/videos', params=params)
+            return tornado.escape.json_decode(response.body)['items']
+
+        batches = [
+            missing[i:i + self.MAX_IDS]
+            for i in range(0, len(missing), self.MAX_IDS)]
+        results = await tornado.gen.multi(
+            [fetch_batch(batch) for batch in batches])
+        fetched = list(itertools.chain(*results))
+        await self.cache_tracks(provider_id, fetched)
+        tracks.update((t['id'], t) for t in fetched)
+        return [tracks[i] for i in track_ids if i in tracks]
+
     async def mread(self, ids, kw, fields=Available):
-        params = {
-            'part': 'snippet,contentDetails,player,statistics',
-            'fields': self.MREAD_FIELDS,
-            'maxWidth': '320'}
         if 'ids' in kw:
-            params['id'] = ','.join(
-                urllib.parse.quote(i, safe='') for i in kw['ids'])
+            track_list = await self.hydrate(ids['provider_id'], kw['ids'])
         elif 'rating' in kw:
+            params = dict(self.VIDEO_PARAMS)
             params['myRating'] = kw['rating']
             params['maxResults'] = self.MAX_RESULTS
+            response = await self.fetch(
+                ids['provider_id'], '/videos', params=params)
+            track_list = tornado.escape.json_decode(response.body)['items']
+            await self.cache_tracks(ids['provider_id'], track_list)
         else:
             raise ControllerException(400, 'missing ids or rating')
-        response = await self.fetch(
-            ids['provider_id'], '/videos', params=params)
-        track_list = tornado.escape.json_decode(response.body)
         entities = []
-        account = self.get_account(ids['provider_id'])
-        for track in track_list['items']:
+        account = await self.load_account(ids['provider_id'])
+        for track in track_list:
             try:
                 entity = Track.from_youtube(track)
             except (KeyError, ValueError):
@@ -172,15 +339,12 @@ class YoutubeTrackController(TrackController):
             'fields': self.SEARCH_FIELDS}
         if kw.get('duration') in ('any', 'long', 'medium', 'short'):
             params['videoDuration'] = kw['duration']
-        response = await self.fetch(
-            ids['provider_id'], '/search', params=params)
-        search_result = tornado.escape.json_decode(response.body)
-        video_ids = [i['id']['videoId'] for i in search_result['items']]
-
-        futures = []
-        for i, j in chunk_range(len(video_ids)):
-            tracks = self.mread(ids, {'ids': video_ids[i: j]}, fields=fields)
-            futures.append(tracks)
-
-        entities = await tornado.gen.multi(futures)
-        return list(itertools.chain(*entities))
+
+        async def fetch():
+            response = await self.fetch(
+                ids['provider_id'], '/search', params=params)
+            search_result = tornado.escape.json_decode(response.body)
+            return [i['id']['videoId'] for i in search_result['items']]
+
+        video_ids = await self.cached_search(ids['provider_id'], kw, fetch)
+        return await self.mread(ids, {'ids': video_ids}, fields=fields)
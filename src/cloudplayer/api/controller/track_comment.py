@@ -46,6 +46,6 @@ class SoundcloudTrackCommentController(Controller):
                     comment['created_at'], self.DATE_FORMAT))
             entities.append(entity)
 
-        account = self.get_account(entity.provider_id)
+        account = await self.load_account(entity.provider_id)
         self.policy.grant_read(account, entities, fields)
         return entities
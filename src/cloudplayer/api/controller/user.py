@@ -16,6 +16,8 @@ class UserController(Controller):
     async def read(self, ids):
         if ids['id'] == 'me':
             ids['id'] = self.current_user['user_id']
+        if ids['id'] is None:
+            raise ControllerException(404, 'user not found')
         try:
             entity = await super().read(ids)
         except ControllerException:
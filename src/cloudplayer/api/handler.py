@@ -13,6 +13,7 @@ import tornado.web
 from tornado.log import app_log, gen_log
 
 from cloudplayer.api import APIException
+from cloudplayer.api.model import serialize
 
 
 class HandlerMixin(object):
@@ -27,14 +28,12 @@ class HandlerMixin(object):
     @property
     def pubsub(self):
         if not hasattr(self, '_pubsub'):
-            self._pubsub = self.cache.pubsub()
-            self._pubsub.subscribe(keep_alive=lambda _: True)
+            self._pubsub = self.application.multiplexer.subscription()
         return self._pubsub
 
     @pubsub.setter
     def pubsub(self, value):
         self._pubsub = value
-        self._pubsub.subscribe(keep_alive=lambda _: True)
 
     @property
     def db(self):
@@ -42,6 +41,16 @@ class HandlerMixin(object):
             self._db = self.application.database.create_session()
         return self._db
 
+    async def render(self, data):
+        """Serialize `data` through the session.
+
+        Relations the controllers did not load are lazy loaded while
+        serializing, which has to await the database like any query.
+        """
+        if data is None:
+            return None
+        return await self.db.run(serialize, data)
+
     def on_finish(self):
         if hasattr(self, '_db'):
             self._db.close()
@@ -85,15 +94,15 @@ class EntityMixin(ControllerHandlerMixin):
 
     async def get(self, **ids):
         entity = await self.controller.read(ids)
-        self.write(entity)
+        self.write(await self.render(entity))
 
     async def put(self, **ids):
         entity = await self.controller.update(ids, self.body)
-        self.write(entity)
+        self.write(await self.render(entity))
 
     async def patch(self, **ids):
         entity = await self.controller.update(ids, self.body)
-        self.write(entity)
+        self.write(await self.render(entity))
 
     async def delete(self, **ids):
         await self.controller.delete(ids)
@@ -115,11 +124,26 @@ class CollectionMixin(ControllerHandlerMixin):
 
     SUPPORTED_METHODS = ('GET', 'POST')
 
+    __streaming__ = False
+
     async def get(self, **ids):
         query = dict(self.query_params)
+        if self.__streaming__:
+            await self.write_stream(self.controller.stream(ids, query))
+            return
         entities = await self.controller.search(ids, query)
-        self.write(entities)
+        cursor = getattr(entities, 'cursor', None)
+        if cursor:
+            self.set_next_page(query, cursor)
+        self.write(await self.render(entities))
+
+    def set_next_page(self, query, cursor):
+        """Link the page following the current one of the collection."""
+        url = tornado.httputil.url_concat(
+            self.request.path, dict(query, after=cursor))
+        self.set_header('Link', '<{}>; rel="next"'.format(url))
+        self.set_header('X-Next-Cursor', cursor)
 
     async def post(self, **ids):
         entity = await self.controller.create(ids, self.body)
-        self.write(entity)
+        self.write(await self.render(entity))
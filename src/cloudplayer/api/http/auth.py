@@ -23,6 +23,8 @@ from cloudplayer.api.http import HTTPHandler
 class AuthHandler(
         ControllerHandlerMixin, HTTPHandler, tornado.auth.OAuth2Mixin):
 
+    PROVISIONAL_METHODS = ()
+
     _OAUTH_NO_CALLBACKS = False
     _OAUTH_VERSION = '1.0a'
     _OAUTH_RESPONSE_TYPE = 'code'
@@ -46,6 +48,11 @@ class AuthHandler(
     def _OAUTH_REDIRECT_URI(self):
         return opt.options[self.__provider__]['redirect_uri']
 
+    async def prepare(self):
+        await super().prepare()
+        # The auth controller looks up the account of the current user
+        await self.db.run(getattr, self, 'controller')
+
     async def get(self):
         if self.get_argument('code', None) is not None:
             try:
@@ -95,15 +102,18 @@ class AuthHandler(
         # retrieve account info using access_token
         account_info = await self.fetch_account(access_info)
         # update or create a new account for this provider
-        self.controller.update_account(access_info, account_info)
+        await self.db.run(
+            self.controller.update_account, access_info, account_info)
+        await self.db.run(self.sync_current_user)
+        self.set_user_cookie()
 
-        # sync user account info back to cookie
+    def sync_current_user(self):
+        """Sync user account info back to cookie."""
         self.current_user['user_id'] = self.controller.account.user_id
         for p in opt.options['providers']:
             self.current_user[p] = None
         for a in self.controller.account.user.accounts:
             self.current_user[a.provider_id] = a.id
-        self.set_user_cookie()
 
 
 class Soundcloud(AuthHandler):
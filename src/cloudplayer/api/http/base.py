@@ -6,6 +6,7 @@
     :license: GPL-3.0, see LICENSE for details
 """
 import json
+import time
 
 import jwt
 import jwt.exceptions
@@ -16,7 +17,7 @@ import tornado.web
 
 from cloudplayer.api import APIException
 from cloudplayer.api.handler import HandlerMixin
-from cloudplayer.api.model import Encoder
+from cloudplayer.api.model import serialize
 from cloudplayer.api.model.account import Account
 from cloudplayer.api.model.favourite import Favourite
 from cloudplayer.api.model.user import User
@@ -31,6 +32,8 @@ class HTTPException(APIException):
 class HTTPHandler(HandlerMixin, tornado.web.RequestHandler):
 
     SUPPORTED_METHODS = ('GET', 'POST', 'PATCH', 'DELETE', 'OPTIONS')
+    ANONYMOUS_METHODS = ('OPTIONS',)
+    PROVISIONAL_METHODS = ('GET', 'HEAD')
 
     def __init__(self, request, application):
         super().__init__(request, application)
@@ -38,36 +41,72 @@ class HTTPHandler(HandlerMixin, tornado.web.RequestHandler):
         self.original_user = None
 
     def load_user(self):
+        cookie = self.get_cookie(self.settings['jwt_cookie'], '')
+        user = self.application.jwt_cache.get(cookie)
+        if user is not None:
+            self.application.metrics.counter('jwt.cache.hits').increment()
+            return user.copy(), user.copy()
+        self.application.metrics.counter('jwt.cache.misses').increment()
         try:
             user = jwt.decode(
-                self.get_cookie(self.settings['jwt_cookie'], ''),
+                cookie,
                 self.settings['jwt_secret'],
                 algorithms=['HS256'])
-            return user, user.copy()
         except jwt.exceptions.InvalidTokenError:
-            new_user = User()
-            self.db.add(new_user)
-            self.db.commit()
-            new_account = Account(
-                id=str(new_user.id),
-                provider_id='cloudplayer',
-                favourite=Favourite(),
-                user_id=new_user.id)
-            self.db.add(new_account)
-            self.db.commit()
-            user = {p: None for p in self.settings['providers']}
-            user['cloudplayer'] = new_account.id
-            user['user_id'] = new_user.id
-            return None, user
-
-    def prepare(self):
+            return None, None
+        self.cache_user(cookie, user)
+        return user, user.copy()
+
+    def cache_user(self, cookie, user):
+        ttl = None
+        if 'exp' in user:
+            ttl = user['exp'] - time.time()
+        self.application.jwt_cache.set(cookie, user.copy(), ttl=ttl)
+
+    def provisional_user(self):
+        user = {p: None for p in self.settings['providers']}
+        user['user_id'] = None
+        return user
+
+    def create_user(self):
+        new_user = User()
+        self.db.add(new_user)
+        self.db.flush()
+        new_account = Account(
+            id=str(new_user.id),
+            provider_id='cloudplayer',
+            favourite=Favourite(),
+            user_id=new_user.id)
+        self.db.add(new_account)
+        self.db.commit()
+        user = self.provisional_user()
+        user['cloudplayer'] = new_account.id
+        user['user_id'] = new_user.id
+        return user
+
+    async def prepare(self):
         self.original_user, self.current_user = self.load_user()
+        if self.current_user is None:
+            # Anonymous requests stay without identity and reads get a
+            # provisional one, which is neither persisted nor sent as
+            # cookie. Everything else gets a fresh user persisted in a
+            # single transaction
+            if self.request.method in self.ANONYMOUS_METHODS:
+                return
+            elif self.request.method in self.PROVISIONAL_METHODS:
+                self.original_user = self.provisional_user()
+                self.current_user = self.original_user.copy()
+            else:
+                self.current_user = await self.db.run(self.create_user)
 
     def set_user_cookie(self):
         user_jwt = jwt.encode(
             self.current_user,
             self.settings['jwt_secret'],
             algorithm='HS256')
+        if isinstance(user_jwt, bytes):
+            user_jwt = user_jwt.decode('ascii')
+        self.cache_user(user_jwt, self.current_user)
         super().set_cookie(
             self.settings['jwt_cookie'],
             user_jwt,
@@ -85,6 +124,8 @@ class HTTPHandler(HandlerMixin, tornado.web.RequestHandler):
             ('Access-Control-Allow-Headers', 'Accept, Content-Type, Origin'),
             ('Access-Control-Allow-Methods', self.allowed_methods),
             ('Access-Control-Allow-Origin', self.allowed_origin),
+            ('Access-Control-Expose-Headers',
+             'Link, X-Missing-Providers, X-Next-Cursor'),
             ('Access-Control-Max-Age', '600'),
             ('Cache-Control', 'no-cache, no-store, must-revalidate'),
             ('Content-Language', 'en-US'),
@@ -98,14 +139,46 @@ class HTTPHandler(HandlerMixin, tornado.web.RequestHandler):
     def write(self, data):
         if data is None:
             raise HTTPException(404)
-        json.dump(data, super(), cls=Encoder)
+        if not isinstance(data, bytes):
+            data = serialize(data)
+        super().write(data)
         self.finish()
 
-    def finish(self, chunk=None):
+    async def write_stream(self, batches):
+        """Write the entities of async iterable `batches` as JSON array.
+
+        Every batch is flushed to the client in a chunk of its own before
+        the next batch is read, so that the response is never held in
+        memory as a whole. Nothing is sent before the first batch was
+        granted, so that errors up to then get a regular error response.
+        Later errors abort the connection, since a finished body would
+        pass for a complete result.
+        """
+        self.update_user_cookie()
+        separator = b'['
+        try:
+            async for batch in batches:
+                chunk = await self.db.run(
+                    lambda: b','.join(serialize(entity) for entity in batch))
+                super().write(separator + chunk)
+                separator = b','
+                await self.flush()
+        except Exception:
+            if self._headers_written:
+                self.request.connection.close()
+            raise
+        super().write(b'[]' if separator == b'[' else b']')
+        self.finish()
+
+    def update_user_cookie(self):
         if self.original_user != self.current_user:
             self.set_user_cookie()
         elif not self.current_user:
             self.clear_user_cookie()
+
+    def finish(self, chunk=None):
+        if not self._headers_written:
+            self.update_user_cookie()
         super().finish(chunk=chunk)
 
     @property
@@ -143,6 +216,7 @@ class HTTPHandler(HandlerMixin, tornado.web.RequestHandler):
 class HTTPFallback(HTTPHandler):
 
     SUPPORTED_METHODS = ('GET',)
+    ANONYMOUS_METHODS = ('GET', 'OPTIONS')
 
     async def get(self, *args, **kwargs):
         raise HTTPException(404, 'endpoint not found')
@@ -151,8 +225,28 @@ class HTTPFallback(HTTPHandler):
 class HTTPHealth(HTTPHandler):
 
     SUPPORTED_METHODS = ('GET',)
+    ANONYMOUS_METHODS = ('GET', 'OPTIONS')
 
     async def get(self, *args, **kwargs):
         self.cache.info('server')
-        self.db.execute('SELECT 1 = 1;').first()
+        await self.db.run(lambda: self.db.execute('SELECT 1 = 1;').first())
         self.write({'status_code': 200, 'reason': 'OK'})
+
+
+class HTTPMetrics(HTTPHandler):
+    """Serves the application metrics to the `metrics_allowed_ips` only."""
+
+    SUPPORTED_METHODS = ('GET',)
+    ANONYMOUS_METHODS = ('GET', 'OPTIONS')
+
+    @property
+    def peer_ip(self):
+        # Unlike `remote_ip` the socket peer is not taken from headers
+        address = getattr(self.request.connection.context, 'address', None)
+        if isinstance(address, tuple):
+            return address[0]
+
+    async def get(self, *args, **kwargs):
+        if self.peer_ip not in self.settings['metrics_allowed_ips']:
+            raise HTTPException(404, 'endpoint not found')
+        self.write(self.application.metrics.summary())
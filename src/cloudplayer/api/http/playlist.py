@@ -20,5 +20,6 @@ class Entity(EntityMixin, HTTPHandler):
 class Collection(CollectionMixin, HTTPHandler):
 
     __controller__ = PlaylistController
+    __streaming__ = True
 
     SUPPORTED_METHODS = ('GET', 'POST', 'OPTIONS')
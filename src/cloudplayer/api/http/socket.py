@@ -7,7 +7,6 @@
 """
 import json
 
-import tornado.ioloop
 from tornado.websocket import WebSocketHandler
 
 from cloudplayer.api.http import HTTPHandler
@@ -16,14 +15,12 @@ from cloudplayer.api.ws import WSRequest
 
 class Handler(HTTPHandler, WebSocketHandler):
 
+    PROVISIONAL_METHODS = ()
+
     def __init__(self, application, request):
         WebSocketHandler.__init__(self, application, request)
         HTTPHandler.__init__(self, application, request)
 
-    def open(self):
-        self.listener = tornado.ioloop.PeriodicCallback(self.listen, 100)
-        self.listener.start()
-
     async def on_message(self, message):
         try:
             message = json.loads(message)
@@ -49,17 +46,8 @@ class Handler(HTTPHandler, WebSocketHandler):
             request.finish()
             handler.on_finish()
 
-    def listen(self):
-        if self.pubsub.subscribed:
-            self.pubsub.get_message(ignore_subscribe_messages=True)
-        else:
-            self.pubsub.close()
-            if self.listener.is_running():
-                self.listener.stop()
-
     def on_close(self):
-        if self.pubsub:
-            self.pubsub.unsubscribe()
+        self.pubsub.close()
 
     def check_origin(self, origin):
         return origin in self.settings['allowed_origins']
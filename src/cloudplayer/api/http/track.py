@@ -18,6 +18,14 @@ class Collection(CollectionMixin, HTTPHandler):
 
     SUPPORTED_METHODS = ('GET', 'OPTIONS')
 
+    async def get(self, **ids):
+        query = dict(self.query_params)
+        tracks = await self.controller.search(ids, query)
+        if tracks.missing:
+            self.set_header(
+                'X-Missing-Providers', ', '.join(tracks.missing))
+        self.write(tracks)
+
 
 class SoundcloudEntity(EntityMixin, HTTPHandler):
 
@@ -15,3 +15,9 @@ class Entity(EntityMixin, HTTPHandler):
     __controller__ = UserController
 
     SUPPORTED_METHODS = ('GET',)
+
+    async def get(self, **ids):
+        # Clients without cookie bootstrap their identity by reading `me`
+        if ids.get('id') == 'me' and self.current_user['user_id'] is None:
+            self.current_user = await self.db.run(self.create_user)
+        await super().get(**ids)
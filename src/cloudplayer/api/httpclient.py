@@ -0,0 +1,46 @@
+"""
+    cloudplayer.api.httpclient
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2018 by Nicolas Drebenstedt
+    :license: GPL-3.0, see LICENSE for details
+"""
+import pycurl
+import tornado.curl_httpclient
+
+
+def enable_keepalive(curl):
+    """Keep idle upstream connections alive for reuse."""
+    curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+    curl.setopt(pycurl.TCP_KEEPIDLE, 60)
+    curl.setopt(pycurl.TCP_KEEPINTVL, 30)
+
+
+class CurlHTTPClient(tornado.curl_httpclient.CurlAsyncHTTPClient):
+    """Curl client with per-host connection limits and queue metrics.
+
+    Requests beyond `max_clients` wait in the client's queue, requests
+    beyond `max_host_connections` to the same host wait inside curl.
+    The time spent in the queue is recorded as `httpclient.queue_ms`.
+    """
+
+    def initialize(self, max_clients=10, defaults=None,
+                   max_host_connections=None, tcp_keepalive=False,
+                   metrics=None):
+        defaults = dict(defaults or {})
+        if tcp_keepalive:
+            defaults.setdefault('prepare_curl_callback', enable_keepalive)
+        super().initialize(max_clients=max_clients, defaults=defaults)
+        if max_host_connections:
+            self._multi.setopt(
+                pycurl.M_MAX_HOST_CONNECTIONS, max_host_connections)
+        self.metrics = metrics
+
+    def fetch_impl(self, request, callback):
+        def on_response(response):
+            queue = response.time_info.get('queue')
+            if self.metrics and queue is not None:
+                self.metrics.histogram('httpclient.queue_ms').observe(
+                    1000.0 * queue)
+            callback(response)
+        super().fetch_impl(request, on_response)
@@ -0,0 +1,106 @@
+"""
+    cloudplayer.api.metrics
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2018 by Nicolas Drebenstedt
+    :license: GPL-3.0, see LICENSE for details
+"""
+import collections
+import threading
+
+
+def percentile(samples, q):
+    """Nearest-rank percentile `q` of an already sorted list of samples."""
+    if not samples:
+        return None
+    return samples[min(int(len(samples) * q), len(samples) - 1)]
+
+
+class Counter(object):
+    """Monotonic counter that can be incremented from worker threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def increment(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def summary(self):
+        return self.value
+
+
+class Histogram(object):
+    """Records observations and summarizes them as percentiles.
+
+    Count and sum cover the whole lifetime of the histogram, whereas
+    percentiles are computed over the most recent `size` observations.
+    """
+
+    def __init__(self, size=1024):
+        self._lock = threading.Lock()
+        self._samples = collections.deque(maxlen=size)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        with self._lock:
+            self._samples.append(value)
+            self.count += 1
+            self.sum += value
+
+    def percentile(self, q):
+        with self._lock:
+            samples = sorted(self._samples)
+        return percentile(samples, q)
+
+    def summary(self):
+        with self._lock:
+            samples = sorted(self._samples)
+            count, sum_ = self.count, self.sum
+        return {
+            'count': count,
+            'sum': sum_,
+            'p50': percentile(samples, 0.5),
+            'p90': percentile(samples, 0.9),
+            'p99': percentile(samples, 0.99),
+            'max': percentile(samples, 1.0)}
+
+
+class Metrics(object):
+    """Registry of named counters, histograms and gauges.
+
+    Counters and histograms are created on first access, gauges are
+    callables that are evaluated whenever a summary is requested.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def counter(self, name):
+        if name not in self.counters:
+            with self._lock:
+                self.counters.setdefault(name, Counter())
+        return self.counters[name]
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            with self._lock:
+                self.histograms.setdefault(name, Histogram())
+        return self.histograms[name]
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def summary(self):
+        return {
+            'counters': {
+                n: c.summary() for n, c in self.counters.items()},
+            'histograms': {
+                n: h.summary() for n, h in self.histograms.items()},
+            'gauges': {
+                n: g() for n, g in self.gauges.items()}}
@@ -1,8 +1,10 @@
-from .base import Base, Encoder, Transient
+from .base import Base, Encoder, Transient, envelope, serialize
 
 __all__ = [
     'Base',
     'Encoder',
-    'Transient'
+    'Transient',
+    'envelope',
+    'serialize'
 ]
 __import__('pkg_resources').declare_namespace(__name__)
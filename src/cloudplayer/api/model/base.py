@@ -6,22 +6,26 @@
     :license: GPL-3.0, see LICENSE for details
 """
 import datetime
+import functools
 import json
-import time
+import operator
 
-import redis
-import redis.exceptions
 import sqlalchemy as sql
 import sqlalchemy.inspection
+import sqlalchemy.orm
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.orm import RelationshipProperty
 from sqlalchemy.sql import expression
 from sqlalchemy.types import DateTime
-from tornado.log import app_log
 
 from cloudplayer.api.access import Deny, Fields
 
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
 
 class utcnow(expression.FunctionElement):
     type = DateTime()
@@ -32,6 +36,34 @@ def pg_utcnow(element, compiler, **kw):
     return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
 
 
+NO_FIELDS = Fields()
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_fields(values):
+    """Split a frozenset of dotted field names into a field tree.
+
+    Returns the top level fields and a tuple of relation names paired
+    with the fields to render on the related entities.
+    """
+    tree = {}
+    flat = []
+    for field in values:
+        key, *path = field.split('.', 1)
+        flat.append(key)
+        if path:
+            tree.setdefault(key, []).extend(path)
+    return Fields(*flat), tuple(
+        (key, Fields(*paths)) for key, paths in tree.items())
+
+
+@functools.lru_cache(maxsize=None)
+def inspect_relation(cls, field):
+    """Tell whether `field` of a mapped class is a (to many) relation."""
+    prop = getattr(cls, field).property
+    return isinstance(prop, RelationshipProperty), prop.uselist
+
+
 class Transient(object):
 
     __acl__ = (Deny(),)
@@ -61,7 +93,7 @@ class Transient(object):
 
     @property
     def fields(self):
-        return getattr(self, '_fields', Fields())
+        return getattr(self, '_fields', NO_FIELDS)
 
     @fields.setter
     def fields(self, value):
@@ -77,14 +109,8 @@ class Transient(object):
 
             {'foo': [{'bar': 73}, {'bar': 89}]}
         """
-        tree = {}
-        flat = []
-        for field in value:
-            key, *path = field.split('.', 1)
-            flat.append(key)
-            if path:
-                tree[key] = tree.get(key, []) + list(path)
-        for field, paths in tree.items():
+        flat, tree = parse_fields(frozenset(value))
+        for field, paths in tree:
             should_expand, is_list = self._inspect_field(field)
             if should_expand:
                 relations = getattr(self, field)
@@ -92,8 +118,8 @@ class Transient(object):
                     relations = [relations]
                 for relation in relations:
                     if isinstance(relation, Base):
-                        relation.fields = Fields(*paths)
-        self._fields = Fields(*flat)
+                        relation.fields = paths
+        self._fields = flat
 
     @property
     def account(self):
@@ -124,10 +150,7 @@ class Model(Transient):
         sql.DateTime, server_default=utcnow(), onupdate=utcnow())
 
     def _inspect_field(self, field):
-        prop = getattr(type(self), field).property
-        should_expand = isinstance(prop, RelationshipProperty)
-        is_list = prop.uselist
-        return should_expand, is_list
+        return inspect_relation(type(self), field)
 
     @property
     def account(self):
@@ -145,49 +168,104 @@ class Model(Transient):
         return False
 
     @staticmethod
-    def event_hook(redis_pool, method, mapper, connection, target):
+    def event_hook(method, mapper, connection, target):
+        """Queue change events on the session of `target`.
+
+        Events are rendered during the flush while the target is still
+        fully loaded, but only published once the session commits.
+        """
+        session = sqlalchemy.orm.object_session(target)
+        events = session.info.setdefault('events', [])
         target.fields = Fields(*target.__fields__)
-        cache = redis.Redis(connection_pool=redis_pool)
+        body = serialize(target)
         for pattern in target.__channel__:
             channel = pattern.format(**target.__dict__)
-            message = json.dumps({
-                'channel': channel,
-                'method': method,
-                'body': target},
-                cls=Encoder)
-
-            start = time.time()
-            try:
-                cache.publish(channel, message)
-            except redis.exceptions.ConnectionError:
-                status_code = 503
-                host = '::1'
-            else:
-                status_code = 200
-                host = cache.connection_pool.connection_kwargs['host']
-
-            pub_time = 1000.0 * (time.time() - start)
-            app_log.info('{} REDIS {} {} ({}) {:.2f}ms'.format(
-                status_code, method.upper(), channel, host, pub_time))
+            message = envelope(body, channel=channel, method=method)
+            events.append((method, channel, message))
 
 
 Base = declarative_base(cls=Model)
 
 
+@functools.lru_cache(maxsize=4096)
+def field_getter(cls, fields):
+    """Build a function reading the granted `fields` of a `cls` entity.
+
+    Getters are cached per class and fields instance, which the field
+    tree parsing shares between all entities granted the same fields.
+    """
+    names = tuple(fields)
+    if not names:
+        return lambda obj: {}
+    getter = operator.attrgetter(*names)
+    if len(names) == 1:
+        return lambda obj: {names[0]: getter(obj)}
+    return lambda obj: dict(zip(names, getter(obj)))
+
+
+def render_entity(obj):
+    dict_ = field_getter(type(obj), obj.fields)(obj)
+    if dict_.get('id'):  # TODO: There must be a better solution
+        dict_['id'] = str(dict_['id'])
+    return dict_
+
+
+RENDERERS = {
+    Transient: render_entity,
+    datetime.datetime: lambda obj: obj.isoformat(),
+    datetime.timedelta: lambda obj: obj.total_seconds()}
+
+
+def find_renderer(cls):
+    """Look up the renderer of the closest base class and remember it."""
+    for base in cls.__mro__:
+        if base in RENDERERS:
+            RENDERERS[cls] = RENDERERS[base]
+            return RENDERERS[cls]
+    raise TypeError('{} is not JSON serializable'.format(cls.__name__))
+
+
+def render(obj):
+    """Render an object unknown to JSON, like an entity, into JSON types.
+
+    Renderers are dispatched on the type of `obj`, so that no exceptions
+    are raised for any of the supported types.
+    """
+    renderer = RENDERERS.get(type(obj))
+    if renderer is None:
+        renderer = find_renderer(type(obj))
+    return renderer(obj)
+
+
 class Encoder(json.JSONEncoder):
     """Custom JSON encoder for rendering granted fields."""
 
     def default(self, obj):
-        try:
-            return json.JSONEncoder.default(self, obj)
-        except:  # NOQA
-            if isinstance(obj, Transient):
-                dict_ = {f: getattr(obj, f) for f in obj.fields}
-                if dict_.get('id'):  # TODO: There must be a better solution
-                    dict_['id'] = str(dict_['id'])
-                return dict_
-            elif isinstance(obj, datetime.datetime):
-                return obj.isoformat()
-            elif isinstance(obj, datetime.timedelta):
-                return obj.total_seconds()
-            return json.JSONEncoder.default(self, obj)
+        return render(obj)
+
+
+ENCODER = json.JSONEncoder(default=render)
+
+
+def serialize(obj):
+    """Encode `obj` into a single JSON byte string.
+
+    Uses `ujson` if it is installed and the standard library otherwise.
+    """
+    if ujson:
+        return ujson.dumps(
+            obj, default=render, ensure_ascii=False,
+            escape_forward_slashes=False).encode('utf-8')
+    return ENCODER.encode(obj).encode('utf-8')
+
+
+def envelope(body, **kw):
+    """Build a JSON message around an already serialized `body`.
+
+    Keyword arguments become members of the message next to the body,
+    which allows wrapping one body for many channels without encoding
+    it again.
+    """
+    members = [serialize(k) + b': ' + serialize(v) for k, v in kw.items()]
+    members.append(b'"body": ' + body)
+    return b'{' + b', '.join(members) + b'}'
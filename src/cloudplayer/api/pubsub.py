@@ -0,0 +1,172 @@
+"""
+    cloudplayer.api.pubsub
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2018 by Nicolas Drebenstedt
+    :license: GPL-3.0, see LICENSE for details
+"""
+import functools
+
+import redis.exceptions
+import tornado.ioloop
+from tornado.log import app_log
+
+
+class Listener(object):
+    """Delivers pubsub messages as soon as their connection is readable.
+
+    Instead of polling every pubsub connection, the listener registers
+    their sockets with the ioloop and drains them when data arrives.
+    Messages are dispatched to the handlers registered on each pubsub.
+    """
+
+    def __init__(self):
+        self.pubsubs = {}
+
+    def add(self, pubsub, on_error=None):
+        """Start delivering messages of a subscribed `pubsub`."""
+        sock = pubsub.connection._sock
+        ioloop = tornado.ioloop.IOLoop.current()
+        ioloop.add_handler(
+            sock, functools.partial(self.read, pubsub), ioloop.READ)
+        self.pubsubs[pubsub] = (ioloop, sock, on_error)
+
+    def remove(self, pubsub):
+        if pubsub in self.pubsubs:
+            ioloop, sock, _ = self.pubsubs.pop(pubsub)
+            ioloop.remove_handler(sock)
+
+    def read(self, pubsub, fd, events):
+        try:
+            while pubsub.connection and pubsub.connection.can_read(0):
+                pubsub.get_message(ignore_subscribe_messages=True)
+        except redis.exceptions.ConnectionError as error:
+            app_log.warning('pubsub connection lost: %s', error)
+            _, _, on_error = self.pubsubs.get(pubsub, (None, None, None))
+            self.remove(pubsub)
+            if on_error:
+                on_error(error)
+
+    def shutdown(self):
+        app_log.info('removing {} pubsub readers'.format(len(self.pubsubs)))
+        for pubsub in list(self.pubsubs):
+            self.remove(pubsub)
+
+
+class Multiplexer(object):
+    """Shares a single Redis subscriber connection across the process.
+
+    Local subscriptions register callbacks for channels and the
+    multiplexer keeps a reference count per channel. Redis is only told
+    to subscribe when the first local listener of a channel arrives and
+    to unsubscribe when the last one goes away.
+    """
+
+    RECONNECT_DELAY = 1.0
+
+    def __init__(self, redis_pool, listener):
+        self.redis_pool = redis_pool
+        self.listener = listener
+        self.channels = {}
+        self.pubsub = None
+
+    def subscription(self):
+        return Subscription(self)
+
+    def connect(self):
+        cache = redis.Redis(connection_pool=self.redis_pool)
+        self.pubsub = cache.pubsub()
+        self.pubsub.subscribe(
+            keep_alive=lambda _: True,
+            **{channel: self.dispatch for channel in self.channels})
+        self.listener.add(self.pubsub, on_error=self.reconnect)
+
+    def ensure_connected(self):
+        if self.pubsub is None:
+            self.connect()
+        else:
+            ioloop, _, _ = self.listener.pubsubs.get(
+                self.pubsub, (None, None, None))
+            if ioloop is not tornado.ioloop.IOLoop.current():
+                self.listener.remove(self.pubsub)
+                self.listener.add(self.pubsub, on_error=self.reconnect)
+
+    def reconnect(self, reason=None):
+        self.disconnect()
+        try:
+            self.connect()
+        except redis.exceptions.ConnectionError as error:
+            app_log.warning('pubsub reconnect failed: %s', error)
+            self.disconnect()
+            tornado.ioloop.IOLoop.current().call_later(
+                self.RECONNECT_DELAY, self.reconnect)
+
+    def disconnect(self):
+        if self.pubsub is not None:
+            self.listener.remove(self.pubsub)
+            self.pubsub.close()
+            self.pubsub = None
+
+    def attach(self, channel, subscription):
+        self.ensure_connected()
+        if channel not in self.channels:
+            self.channels[channel] = set()
+            self.pubsub.subscribe(**{channel: self.dispatch})
+        self.channels[channel].add(subscription)
+
+    def detach(self, channel, subscription):
+        subscriptions = self.channels.get(channel)
+        if subscriptions is None:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self.channels[channel]
+            if self.pubsub is not None:
+                self.pubsub.unsubscribe(channel)
+
+    def dispatch(self, message):
+        channel = message['channel'].decode('utf-8')
+        for subscription in list(self.channels.get(channel, ())):
+            subscription.deliver(channel, message)
+
+    def shutdown(self):
+        app_log.info('closing {} pubsub channels'.format(len(self.channels)))
+        self.channels.clear()
+        self.disconnect()
+
+
+class Subscription(object):
+    """Local view on the multiplexer for a single websocket connection.
+
+    It mimics the subset of the redis pubsub interface used by the
+    controllers, so that `subscribe(channel=callback)` routes messages
+    of `channel` to `callback`.
+    """
+
+    def __init__(self, multiplexer):
+        self.multiplexer = multiplexer
+        self.handlers = {}
+
+    @property
+    def subscribed(self):
+        return bool(self.handlers)
+
+    def subscribe(self, *channels, **registry):
+        registry.update(dict.fromkeys(channels))
+        for channel, handler in registry.items():
+            self.handlers[channel] = handler
+            self.multiplexer.attach(channel, self)
+
+    def unsubscribe(self, *channels):
+        for channel in channels or list(self.handlers):
+            if channel in self.handlers:
+                del self.handlers[channel]
+                self.multiplexer.detach(channel, self)
+
+    def deliver(self, channel, message):
+        handler = self.handlers.get(channel)
+        if handler:
+            handler(message)
+
+    def close(self):
+        self.unsubscribe()
@@ -1,12 +1,16 @@
 from unittest import mock
+
 import pytest
 import sqlalchemy as sql
 
-from cloudplayer.api.access.action import Create, Delete, Query, Read, Update
+from cloudplayer.api.access.action import (Anything, Create, Delete, Query,
+                                           Read, Update)
 from cloudplayer.api.access.fields import Available, Fields
-from cloudplayer.api.access.policy import Policy, PolicyViolation
-from cloudplayer.api.access.rule import Grant
-from cloudplayer.api.model import Base
+from cloudplayer.api.access.policy import Policy, PolicyViolation, compile_acl
+from cloudplayer.api.access.principal import Everyone, Owner
+from cloudplayer.api.access.rule import Allow, Deny, Grant
+from cloudplayer.api.model import Base, Transient
+from cloudplayer.api.model.account import Account
 
 
 def test_policy_grant_should_invoke_rules():
@@ -98,3 +102,103 @@ def test_policy_should_grant_query_for_specified_fields(db):
     assert c_action == Query
     assert isinstance(c_target, MyModel)
     assert c_fields in Fields(*fields)
+
+
+class Owned(Transient):
+
+    __acl__ = (
+        Allow(Owner, Anything, Fields('id', 'title', 'secret')),
+        Allow(Everyone, Read, Fields('id', 'title', 'image.small')),
+        Deny()
+    )
+
+    image = None
+
+    def __init__(self, account):
+        self._account = account
+
+    account = property(lambda self: self._account)
+
+
+def principals():
+    owner = Account(id='1', provider_id='cloudplayer')
+    other = Account(id='2', provider_id='cloudplayer')
+    return owner, Owned(owner), Owned(other)
+
+
+@pytest.mark.parametrize('action', [Read, Update, Delete])
+@pytest.mark.parametrize('fields', [
+    Available, Fields('id'), ('id', 'title'), ('secret',), ('unknown',)])
+def test_policy_compiled_grants_should_match_rule_evaluation(action, fields):
+    account, mine, theirs = principals()
+    for target in (mine, theirs):
+        try:
+            expected = Policy.evaluate(account, action, target, fields)
+        except PolicyViolation as error:
+            with pytest.raises(PolicyViolation) as violation:
+                Policy.grant(account, action, target, fields)
+            assert violation.value.status_code == error.status_code
+        else:
+            grant = Policy.grant(account, action, target, fields)
+            assert set(grant.fields) == set(expected.fields)
+            assert grant.principal is account
+            assert grant.target is target
+
+
+def test_policy_should_memoize_compiled_acls():
+    account, mine, theirs = principals()
+    Policy.grant(account, Read, mine, ('id', 'title'))
+    hits = compile_acl.cache_info().hits
+    Policy.grant(account, Read, theirs, ['title', 'id'])
+    assert compile_acl.cache_info().hits == hits + 1
+
+
+def grant_all(grant, account, targets):
+    for target in targets:
+        grant(account, Read, target, Available)
+
+
+@pytest.mark.benchmark
+def test_policy_compiled_grants_should_outperform_rule_evaluation(
+        throughput):
+    account, mine, theirs = principals()
+    targets = [theirs] * 50
+    before = throughput(
+        'evaluated_per_second', grant_all, Policy.evaluate, account, targets,
+        rounds=200)
+    after = throughput(
+        'compiled_per_second', grant_all, Policy.grant, account, targets,
+        rounds=200)
+    assert after > before
+
+
+def test_policy_should_grant_multi_reads_once_per_owner():
+    account, mine, theirs = principals()
+    also_mine = Owned(Account(id='1', provider_id='cloudplayer'))
+    entities = [mine, theirs, also_mine, theirs]
+    policy = Policy(None, None)
+    with mock.patch.object(Policy, 'grant', wraps=Policy.grant) as grant:
+        grants = policy.grant_read(account, entities, Available)
+    assert grant.call_count == 2
+    assert [g.target for g in grants] == entities
+    assert set(mine.fields) == set(also_mine.fields) == {
+        'id', 'title', 'secret'}
+    assert set(theirs.fields) == {'id', 'title', 'image'}
+
+
+def test_policy_should_grant_multi_reads_of_public_transients_once():
+    from cloudplayer.api.model.track import Track
+    tracks = [Track(id=str(i), provider_id='youtube') for i in range(50)]
+    policy = Policy(None, None)
+    with mock.patch.object(Policy, 'grant', wraps=Policy.grant) as grant:
+        policy.grant_read(None, tracks, Fields('id', 'title'))
+    grant.assert_called_once()
+    assert all(set(t.fields) == {'id', 'title'} for t in tracks)
+
+
+def test_policy_should_grant_uncompiled_multi_reads_one_by_one():
+    rule = mock.MagicMock(return_value=Grant(fields=Fields('id')))
+    entities = [mock.Mock(__acl__=(rule,)) for _ in range(3)]
+    policy = Policy(None, None)
+    policy.grant_read(mock.Mock(), entities, Available)
+    assert rule.call_count == 3
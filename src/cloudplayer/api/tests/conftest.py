@@ -5,11 +5,13 @@ import json
 import os
 import random
 import sys
+import time
 import urllib.parse
 
 import jwt
 import pytest
 import pytest_redis.factories as redis_factories
+import redis
 import tornado.escape
 import tornado.options as opt
 from tornado.httpclient import HTTPRequest, HTTPResponse, HTTPError
@@ -69,6 +71,35 @@ def randstr(
 redis_proc = redis_factories.redis_proc(executable=which('redis-server'))
 
 
+def pytest_addoption(parser):
+    parser.addoption(
+        '--benchmark', action='store_true', default=False,
+        help='run the throughput benchmarks')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark'):
+        return
+    skip = pytest.mark.skip(reason='needs --benchmark to run')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture(scope='function')
+def throughput(record_property):
+
+    def measure(name, func, *args, rounds=20):
+        """Call `func` `rounds` times and record the calls per second."""
+        start = time.perf_counter()
+        for _ in range(rounds):
+            func(*args)
+        per_second = rounds / (time.perf_counter() - start)
+        record_property(name, per_second)
+        return per_second
+    return measure
+
+
 @pytest.fixture(scope='session', autouse=True)
 def app(postgresql_proc, redis_proc):
     opt.define('connect_timeout', default=3, group='httpclient')
@@ -93,13 +124,28 @@ def app(postgresql_proc, redis_proc):
     opt.define('jwt_cookie', default='tok_v1', group='app')
     opt.define('jwt_expiration', default=1, group='app')
     opt.define('jwt_secret', default='secret', group='app')
+    opt.define('jwt_cache_size', default=64, group='app')
+    opt.define('track_cache_size', default=64, group='app')
+    opt.define('track_cache_ttl', default={
+        'soundcloud': 60, 'youtube': 60}, group='app')
+    opt.define('search_cache_size', default=64, group='app')
+    opt.define('search_cache_ttl', default=60, group='app')
+    opt.define('hydrate_concurrency', default=2, group='app')
+    opt.define('search_budget', default=1.0, group='app')
+    opt.define('max_page_size', default=100, group='app')
+    opt.define('stream_batch_size', default=2, group='app')
+    opt.define('rank_rebalance_length', default=32, group='app')
     opt.define('public_domain', default='localhost', group='app')
     opt.define('public_scheme', default='http', group='app')
     opt.define('providers', default=[
         'youtube', 'soundcloud', 'cloudplayer'], group='app')
     opt.define('allowed_origins', default=['*'], group='app')
+    opt.define('metrics_allowed_ips', default=[], group='app')
     opt.define('num_executors', default=1, group='app')
+    opt.define('offload_database', default=False, group='app')
+    opt.define('async_database', default=False, group='app')
     opt.define('redirect_state', default='testing', group='app')
+    opt.define('token_refresh_margin', default=300, group='app')
     opt.define('redis_host', default=redis_proc.host, group='app')
     opt.define('redis_port', default=redis_proc.port, group='app')
     opt.define('redis_db', default=0, group='app')
@@ -109,12 +155,28 @@ def app(postgresql_proc, redis_proc):
     opt.define('postgres_db', default='postgres', group='app')
     opt.define('postgres_user', default='postgres', group='app')
     opt.define('postgres_password', default='', group='app')
-    cloudplayer.api.app.configure_httpclient()
+    opt.define('postgres_pool_size', default=5, group='app')
+    opt.define('postgres_max_overflow', default=10, group='app')
+    opt.define('postgres_pool_timeout', default=30, group='app')
+    opt.define('postgres_pool_recycle', default=-1, group='app')
+    opt.define('postgres_pool_pre_ping', default=True, group='app')
+    opt.define('http_max_clients', default=20, group='app')
+    opt.define('http_max_host_connections', default=5, group='app')
+    opt.define('http_tcp_keepalive', default=True, group='app')
     app = cloudplayer.api.app.Application()
+    cloudplayer.api.app.configure_httpclient(app.metrics)
     yield app
     app.database.engine.dispose()
 
 
+@pytest.fixture(scope='function', autouse=True)
+def cache(app):
+    yield redis.Redis(connection_pool=app.redis_pool)
+    app.track_cache.local.clear()
+    app.search_cache.local.clear()
+    redis.Redis(connection_pool=app.redis_pool).flushdb()
+
+
 @pytest.fixture(scope='function')
 def db(app):
     import cloudplayer.api.model.base as model
@@ -7,6 +7,7 @@ import asynctest
 import pytest
 import sqlalchemy.orm.util
 import tornado.escape
+import tornado.gen
 from cloudplayer.api.controller import ControllerException
 from cloudplayer.api.controller.auth import (AuthController,
                                              SoundcloudAuthController,
@@ -314,3 +315,173 @@ def test_youtube_auth_extracts_account_info_from_items(
     monkeypatch.setattr(AuthController, 'update_account', update_account)
     controller.update_account({}, {'items': [account_info], 'foo': 'bar'})
     update_account.assert_called_once_with({}, account_info)
+
+
+def refresh_fetch(calls, delay=0.05):
+    async def fetch(path, method=None, **kw):
+        response = mock.Mock()
+        response.error = None
+        if method == 'POST':
+            calls.append(path)
+            await tornado.gen.sleep(delay)
+            response.body = json.dumps({
+                'access_token': 'new-access-token',
+                'expires_in': 3600})
+        else:
+            response.body = json.dumps({'path': path})
+        return response
+    return fetch
+
+
+@pytest.mark.gen_test
+async def test_auth_controller_should_coalesce_concurrent_refreshes(
+        app, db, current_user):
+    calls = []
+    other_db = app.database.create_session()
+    controllers = [
+        CloudplayerController(db, current_user),
+        CloudplayerController(other_db, current_user)]
+    controllers[0].account.token_expiration = datetime.datetime(2015, 7, 14)
+    db.commit()
+    controllers[1].account.token_expiration = datetime.datetime(2015, 7, 14)
+
+    with mock.patch.object(
+            CloudplayerController, 'fetch_async',
+            staticmethod(refresh_fetch(calls))):
+        await tornado.gen.multi([c.fetch('/path') for c in controllers])
+    other_db.close()
+
+    assert calls == ['cp://base-api/auth']
+    for controller in controllers:
+        assert controller.account.access_token == 'new-access-token'
+        assert controller._should_refresh is False
+
+
+@pytest.mark.gen_test
+async def test_auth_controller_should_not_reload_shared_accounts(
+        db, current_user):
+    calls = []
+    controller = CloudplayerController(db, current_user)
+    controller.account.token_expiration = datetime.datetime(2015, 7, 14)
+    db.commit()
+
+    with mock.patch.object(
+            CloudplayerController, 'fetch_async',
+            staticmethod(refresh_fetch(calls))):
+        with mock.patch.object(
+                db, 'refresh', side_effect=db.refresh) as refresh:
+            await tornado.gen.multi(
+                [controller.fetch('/path') for _ in range(3)])
+
+    assert calls == ['cp://base-api/auth']
+    assert not refresh.called
+    assert controller.account.access_token == 'new-access-token'
+
+
+@pytest.mark.gen_test
+async def test_auth_controller_should_wait_for_refresh_of_other_process(
+        app, db, current_user, cache, io_loop):
+    calls = []
+    controller = CloudplayerController(db, current_user)
+    controller.account.token_expiration = datetime.datetime(2015, 7, 14)
+    db.commit()
+    cache.set(controller._refresh_key, 1)
+
+    def refreshed_elsewhere():
+        other_db = app.database.create_session()
+        account = other_db.query(Account).get(
+            (current_user['cloudplayer'], 'cloudplayer'))
+        account.access_token = 'other-access-token'
+        account.token_expiration = (
+            datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+        other_db.commit()
+        other_db.close()
+        cache.delete(controller._refresh_key)
+
+    io_loop.call_later(0.2, refreshed_elsewhere)
+    with mock.patch.object(controller, 'fetch_async', refresh_fetch(calls)):
+        await controller.fetch('/path')
+
+    assert calls == []
+    assert controller.account.access_token == 'other-access-token'
+
+
+@pytest.mark.gen_test
+async def test_auth_controller_should_refresh_in_background_before_expiry(
+        app, db, current_user):
+    calls = []
+    controller = CloudplayerController(db, current_user)
+    controller.account.access_token = 'old-access-token'
+    controller.account.token_expiration = (
+        datetime.datetime.utcnow() + datetime.timedelta(seconds=60))
+    db.commit()
+
+    with mock.patch.object(
+            CloudplayerController, 'fetch_async',
+            staticmethod(refresh_fetch(calls))):
+        response = await controller.fetch('/path')
+        fetched = tornado.escape.json_decode(response.body)
+        assert 'old-access-token' in fetched['path']
+        assert calls == []
+        await tornado.gen.sleep(0.2)
+
+    assert calls == ['cp://base-api/auth']
+    db.refresh(controller.account)
+    assert controller.account.access_token == 'new-access-token'
+
+
+@pytest.mark.gen_test
+async def test_auth_controller_should_read_client_id_from_registry(db):
+    controller = CloudplayerController(db, {})
+    assert controller.client_id == 'cp-api-key'
+
+    async def fetch(path, **kw):
+        response = mock.Mock()
+        response.body = json.dumps({'path': path})
+        return response
+
+    with mock.patch.object(controller, 'fetch_async', fetch):
+        with mock.patch.object(db, 'merge') as merge:
+            with mock.patch.object(db, 'query') as query:
+                await controller.fetch('/path')
+    merge.assert_not_called()
+    query.assert_not_called()
+
+
+@pytest.mark.gen_test
+async def test_auth_controller_should_refresh_after_failed_other_process(
+        db, current_user, cache, io_loop):
+    calls = []
+    controller = CloudplayerController(db, current_user)
+    controller.account.token_expiration = datetime.datetime(2015, 7, 14)
+    db.commit()
+    cache.set(controller._refresh_key, 'other-token')
+    io_loop.call_later(0.2, cache.delete, controller._refresh_key)
+
+    with mock.patch.object(controller, 'fetch_async', refresh_fetch(calls)):
+        await controller.fetch('/path')
+
+    assert calls == ['cp://base-api/auth']
+    assert controller.account.access_token == 'new-access-token'
+    assert not cache.exists(controller._refresh_key)
+
+
+@pytest.mark.gen_test
+async def test_auth_controller_should_keep_refresh_lock_of_other_holder(
+        db, current_user, cache):
+    calls = []
+    controller = CloudplayerController(db, current_user)
+    controller.account.token_expiration = datetime.datetime(2015, 7, 14)
+    db.commit()
+    fetch = refresh_fetch(calls)
+
+    async def expiring_fetch(path, **kw):
+        # The lock timed out and was taken over during the refresh
+        cache.set(controller._refresh_key, 'other-token')
+        return await fetch(path, **kw)
+
+    with mock.patch.object(controller, 'fetch_async', expiring_fetch):
+        await controller.fetch('/path')
+
+    assert cache.get(controller._refresh_key) == b'other-token'
+    cache.delete(controller._refresh_key)
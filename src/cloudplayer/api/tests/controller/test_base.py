@@ -5,7 +5,7 @@ import pytest
 import sqlalchemy.orm.util
 
 import cloudplayer.api.controller.auth
-from cloudplayer.api.access import Fields
+from cloudplayer.api.access import Available, Fields
 from cloudplayer.api.controller.base import (Controller, ControllerException,
                                              ProviderRegistry)
 from cloudplayer.api.model.account import Account
@@ -86,6 +86,28 @@ async def test_base_controller_should_delegate_provider_fetches_to_auth_ctrls(
     fetch.assert_called_once_with('/path', params=params)
 
 
+@pytest.mark.gen_test
+async def test_controller_should_run_blocking_work_through_session(
+        current_user):
+    db = mock.Mock(run=asynctest.CoroutineMock(return_value=42))
+    controller = MyController(db, current_user, Account, mock.Mock())
+    assert await controller.read({'id': 'foo'}) == 42
+    db.run.assert_called_once_with(controller._read, {'id': 'foo'}, Available)
+
+
+@pytest.mark.gen_test
+async def test_controller_should_load_accounts_through_session(
+        current_user):
+    account = mock.Mock()
+    db = mock.Mock(run=asynctest.CoroutineMock(return_value=account))
+    controller = MyController(db, current_user, Account, mock.Mock())
+    assert await controller.load_account('cloudplayer') is account
+    db.run.assert_called_once_with(controller.get_account, 'cloudplayer')
+    controller._accounts = {'cloudplayer': account}
+    assert await controller.load_account('cloudplayer') is account
+    assert db.run.call_count == 1
+
+
 @pytest.mark.gen_test
 async def test_controller_should_create_entity_and_read_result(
         db, current_user, account, user):
@@ -251,3 +273,30 @@ async def test_controller_should_search_using_query_and_read_all_entities(
     assert controller.policy.grant_read.call_args[0][:-1] == (
         account, entities)
     assert set(controller.policy.grant_read.call_args[0][-1]) == {'id'}
+
+
+@pytest.mark.gen_test
+async def test_base_controller_should_reuse_auth_ctrls_per_session(
+        app, db, current_user, monkeypatch):
+    current_user['soundcloud'] = 'sc-id'
+    fetch = asynctest.CoroutineMock()
+    for_provider = mock.MagicMock(return_value=mock.Mock(fetch=fetch))
+    monkeypatch.setattr(cloudplayer.api.controller.auth.AuthController,
+                        'for_provider', for_provider)
+    saved = app.metrics.counter('auth.lookups_saved').value
+
+    controllers = [
+        MyController(db, current_user, mock.Mock(), mock.Mock()),
+        MyController(db, current_user, mock.Mock(), mock.Mock())]
+    for controller in controllers:
+        await controller.fetch('soundcloud', '/path')
+        await controller.fetch('soundcloud', '/path')
+    await controllers[0].fetch('soundcloud', '/path')
+
+    for_provider.assert_called_once_with('soundcloud', db, current_user)
+    assert fetch.call_count == 5
+    assert app.metrics.counter('auth.lookups_saved').value == saved + 4
+
+    MyController(db, {}, mock.Mock(), mock.Mock()).get_auth_controller(
+        'soundcloud')
+    assert for_provider.call_count == 2
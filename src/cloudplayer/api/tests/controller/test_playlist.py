@@ -36,3 +36,24 @@ async def test_playlist_controller_should_create_entity_and_read_result(
     assert entity.title == 'foo'
     assert entity.account is account
     assert sqlalchemy.orm.util.object_state(entity).persistent
+
+
+@pytest.mark.gen_test
+async def test_playlist_controller_should_stream_entities_in_batches(
+        db, current_user, account):
+    for title in ('a', 'b', 'c', 'd', 'e'):
+        db.add(Playlist(
+            account_id=account.id,
+            account_provider_id=account.provider_id,
+            provider_id='cloudplayer',
+            title=title))
+    db.commit()
+    controller = PlaylistController(db, current_user)
+    ids = {'provider_id': 'cloudplayer'}
+    kw = {'account_id': account.id}
+    batches = []
+    async for batch in controller.stream(ids, kw):
+        batches.append(batch)
+    assert [len(b) for b in batches] == [2, 2, 1]
+    assert {p.title for b in batches for p in b} == set('abcde')
+    assert all(set(p.fields) >= {'id', 'title'} for b in batches for p in b)
@@ -1,4 +1,14 @@
+from unittest import mock
+import itertools
+import json
+
 import pytest
+import tornado.gen
+import tornado.options as opt
+
+from cloudplayer.api.controller.track import (SoundcloudTrackController,
+                                              TrackController,
+                                              YoutubeTrackController)
 
 
 @pytest.mark.gen_test
@@ -13,3 +23,155 @@ def test_youtube_track_controller_should_retrieve_and_convert_tracks(
         user_fetch, expect):
     response = yield user_fetch('/track/youtube?q=test')
     assert response.json() == expect('/tracks/youtube')
+
+
+@pytest.mark.gen_test
+async def test_soundcloud_track_controller_should_read_cached_tracks(
+        db, current_user):
+    controller = SoundcloudTrackController(db, current_user)
+    tracks = await controller.search({'provider_id': 'soundcloud'}, {})
+    with mock.patch.object(controller, 'fetch') as fetch:
+        track = await controller.read({
+            'provider_id': 'soundcloud', 'id': str(tracks[0].id)})
+    fetch.assert_not_called()
+    assert track.id == tracks[0].id
+
+
+@pytest.mark.gen_test
+async def test_youtube_track_controller_should_read_cached_tracks(
+        db, current_user):
+    controller = YoutubeTrackController(db, current_user)
+    tracks = await controller.search({'provider_id': 'youtube'}, {})
+    track_ids = [t.id for t in reversed(tracks[:3])]
+    with mock.patch.object(controller, 'fetch') as fetch:
+        cached = await controller.mread(
+            {'provider_id': 'youtube'}, {'ids': track_ids})
+    fetch.assert_not_called()
+    assert [t.id for t in cached] == track_ids
+
+
+@pytest.mark.gen_test
+async def test_track_controller_should_coalesce_and_cache_searches(
+        db, current_user):
+    controller = SoundcloudTrackController(db, current_user)
+    ids = {'provider_id': 'soundcloud'}
+    with mock.patch.object(
+            controller, 'fetch', side_effect=controller.fetch) as fetch:
+        first, second = await tornado.gen.multi([
+            controller.search(ids, {'q': 'Foo  bar'}),
+            controller.search(ids, {'q': 'foo bar'})])
+        third = await controller.search(ids, {'q': ' FOO BAR '})
+    fetch.assert_called_once()
+    assert [t.id for t in first] == [t.id for t in second]
+    assert [t.id for t in first] == [t.id for t in third]
+    assert first[0] is not second[0]
+
+
+def test_track_controller_should_normalize_search_key():
+    key = TrackController.search_key
+    assert key('youtube', {'q': ' Foo  Bar'}) == (
+        'youtube.anonymous.any.foo bar')
+    assert key('youtube', {'q': 'x', 'duration': 'long'}) == (
+        'youtube.anonymous.long.x')
+    assert key('youtube', {'duration': 'forever'}) == 'youtube.anonymous.any.'
+
+
+def test_track_controller_should_scope_search_key_by_account():
+    key = TrackController.search_key
+    assert key('youtube', {'q': 'x'}, '42') == 'youtube.42.any.x'
+    assert key('youtube', {'q': 'x'}, '42') != key('youtube', {'q': 'x'})
+
+
+@pytest.mark.gen_test
+async def test_track_controller_should_not_share_searches_across_accounts(
+        db, current_user):
+    ids = {'provider_id': 'soundcloud'}
+    controllers = [
+        SoundcloudTrackController(db, dict(current_user, soundcloud=i))
+        for i in ('1', '2')]
+    with mock.patch.object(
+            SoundcloudTrackController, 'fetch',
+            side_effect=controllers[0].fetch) as fetch:
+        await tornado.gen.multi([
+            controller.search(ids, {'q': 'foo'})
+            for controller in controllers])
+    assert fetch.call_count == 2
+
+
+@pytest.mark.gen_test
+async def test_youtube_track_controller_should_hydrate_in_capped_batches(
+        db, current_user):
+    controller = YoutubeTrackController(db, current_user)
+    await controller.cache_tracks('youtube', [{'id': 'v0'}, {'id': 'v1'}])
+    batches = []
+    in_flight = [0, 0]
+
+    async def fetch(provider_id, path, params=None):
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight)
+        await tornado.gen.sleep(0.01)
+        in_flight[0] -= 1
+        batch = params['id'].split(',')
+        batches.append(batch)
+        body = json.dumps({'items': [{'id': i} for i in batch]})
+        return mock.Mock(body=body.encode())
+
+    track_ids = ['v{}'.format(i) for i in range(120)] + ['v5']
+    with mock.patch.object(controller, 'fetch', side_effect=fetch):
+        tracks = await controller.hydrate('youtube', track_ids)
+
+    assert [t['id'] for t in tracks] == track_ids[:120]
+    assert sorted(len(b) for b in batches) == [18, 50, 50]
+    assert 'v0' not in itertools.chain(*batches)
+    assert in_flight[1] == opt.options.hydrate_concurrency
+
+
+@pytest.mark.gen_test
+async def test_track_controller_should_return_partial_results_on_deadline(
+        app, db, current_user, monkeypatch):
+    async def slow_search(self, ids, kw, fields=None):
+        await tornado.gen.sleep(opt.options.search_budget + 1)
+
+    monkeypatch.setattr(YoutubeTrackController, 'search', slow_search)
+    controller = TrackController(db, current_user)
+    tracks = await controller.search({}, {'q': 'test'})
+    assert tracks
+    assert {t.provider_id for t in tracks} == {'soundcloud'}
+    assert tracks.missing == ['youtube']
+    histograms = app.metrics.summary()['histograms']
+    assert histograms['track.search.soundcloud_ms']['count'] > 0
+
+
+@pytest.mark.gen_test
+async def test_track_controller_should_mark_failed_providers_missing(
+        db, current_user, monkeypatch):
+    async def failing_search(self, ids, kw, fields=None):
+        raise ValueError('upstream error')
+
+    monkeypatch.setattr(SoundcloudTrackController, 'search', failing_search)
+    controller = TrackController(db, current_user)
+    providers = [p async for p, _ in controller.aggregate({'q': 'test'})]
+    assert providers == ['youtube', 'soundcloud']
+    tracks = await controller.search({}, {'q': 'test'})
+    assert {t.provider_id for t in tracks} == {'youtube'}
+    assert tracks.missing == ['soundcloud']
+
+
+@pytest.mark.gen_test
+async def test_track_controller_should_search_providers_in_own_sessions(
+        db, current_user, monkeypatch):
+    sessions = []
+
+    async def recording_search(self, ids, kw, fields=None):
+        sessions.append(self.db)
+        return []
+
+    monkeypatch.setattr(SoundcloudTrackController, 'search', recording_search)
+    monkeypatch.setattr(YoutubeTrackController, 'search', recording_search)
+    controller = TrackController(db, current_user)
+    with mock.patch.object(type(db), 'close', autospec=True) as close:
+        await controller.search({}, {'q': 'test'})
+    assert len(sessions) == 2
+    assert db not in sessions
+    assert {id(c[0][0]) for c in close.call_args_list} == set(
+        map(id, sessions))
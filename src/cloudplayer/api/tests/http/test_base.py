@@ -1,10 +1,14 @@
 from unittest import mock
 import http.cookies
 
+import jwt
 import pytest
 import tornado.web
 
-from cloudplayer.api.http.base import HTTPFallback, HTTPHandler, HTTPHealth
+import cloudplayer.api.app
+
+from cloudplayer.api.http.base import (HTTPException, HTTPFallback,
+                                       HTTPHandler, HTTPHealth, HTTPMetrics)
 
 
 def test_http_handler_supports_relevant_methods(app, req):
@@ -36,6 +40,8 @@ async def test_http_handler_should_set_default_headers(http_client, base_url):
         'Access-Control-Allow-Headers': 'Accept, Content-Type, Origin',
         'Access-Control-Allow-Methods': 'GET',
         'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers':
+            'Link, X-Missing-Providers, X-Next-Cursor',
         'Access-Control-Max-Age': '600',
         'Cache-Control': 'no-cache, no-store, must-revalidate',
         'Content-Language': 'en-US',
@@ -55,6 +61,57 @@ async def test_http_handler_should_set_new_user_cookie(http_client, base_url):
     assert cookie['expires']
 
 
+@pytest.mark.gen_test
+async def test_http_handler_should_create_user_in_one_commit(
+        http_client, base_url, db):
+    from cloudplayer.api.model.account import Account
+    from cloudplayer.api.model.user import User
+    with mock.patch('cloudplayer.api.app.Session.commit',
+                    autospec=True,
+                    side_effect=cloudplayer.api.app.Session.commit) as commit:
+        await http_client.fetch('{}/user/me'.format(base_url))
+    assert commit.call_count == 1
+    assert db.query(User).count() == 1
+    assert db.query(Account).count() == 1
+
+
+@pytest.mark.gen_test
+@pytest.mark.parametrize('path, method', [
+    ('/health_check', 'GET'),
+    ('/does/not/exist', 'GET'),
+    ('/user/me', 'OPTIONS'),
+    ('/playlist/cloudplayer', 'GET')])
+async def test_http_handler_should_not_create_anonymous_users(
+        http_client, base_url, db, path, method):
+    from cloudplayer.api.model.user import User
+    response = await http_client.fetch(
+        '{}{}'.format(base_url, path), method=method, raise_error=False)
+    assert db.query(User).count() == 0
+    assert 'tok_v1=""' in response.headers.get('Set-Cookie', 'tok_v1=""')
+
+
+@pytest.mark.gen_test
+async def test_http_handler_should_cache_decoded_user_cookies(
+        app, user_fetch):
+    app.jwt_cache.clear()
+    hits = app.metrics.counter('jwt.cache.hits').value
+    with mock.patch('jwt.decode', side_effect=jwt.decode) as decode:
+        await user_fetch('/user/me')
+        await user_fetch('/user/me')
+    decode.assert_called_once()
+    assert app.metrics.counter('jwt.cache.hits').value == hits + 1
+
+
+def test_http_handler_should_respect_jwt_expiry(app, req):
+    handler = HTTPHandler(app, req)
+    with mock.patch('time.time', return_value=100):
+        handler.cache_user('token', {'user_id': 1, 'exp': 160})
+    with mock.patch('time.time', return_value=159):
+        assert app.jwt_cache.get('token') == {'user_id': 1, 'exp': 160}
+    with mock.patch('time.time', return_value=160):
+        assert app.jwt_cache.get('token') is None
+
+
 @pytest.mark.gen_test
 async def test_http_fallback_throws_404_for_get_405_for_others(app, req):
     handler = HTTPFallback(app, req)
@@ -79,3 +136,37 @@ async def test_http_health_should_query_redis_and_postgres(
     await handler.get()
     info.assert_called_once_with('server')
     execute.assert_called_once_with('SELECT 1 = 1;')
+
+
+@pytest.mark.gen_test
+async def test_http_metrics_should_not_be_served_by_default(
+        http_client, base_url):
+    response = await http_client.fetch(
+        '{}/metrics'.format(base_url), raise_error=False)
+    assert response.code == 404
+
+
+@pytest.mark.gen_test
+async def test_http_metrics_should_ignore_forwarded_addresses(
+        app, req, monkeypatch):
+    monkeypatch.setitem(app.settings, 'metrics_allowed_ips', ['10.0.0.1'])
+    req.remote_ip = '10.0.0.1'
+    req.connection.context.address = ('203.0.113.9', 4321)
+    handler = HTTPMetrics(app, req)
+    with pytest.raises(HTTPException) as error:
+        await handler.get()
+    assert error.value.status_code == 404
+
+
+@pytest.mark.gen_test
+async def test_http_metrics_should_write_application_metrics(
+        app, req, monkeypatch):
+    monkeypatch.setitem(app.settings, 'metrics_allowed_ips', ['10.0.0.1'])
+    req.connection.context.address = ('10.0.0.1', 4321)
+    handler = HTTPMetrics(app, req)
+    write = mock.MagicMock()
+    monkeypatch.setattr(handler, 'write', write)
+    await handler.get()
+    summary = write.call_args[0][0]
+    assert set(summary) == {'counters', 'histograms', 'gauges'}
+    assert 'database.pool.size' in summary['gauges']
@@ -1,5 +1,9 @@
+from unittest import mock
+
 import pytest
+import tornado.httpclient
 
+from cloudplayer.api.controller.playlist import PlaylistController
 from cloudplayer.api.model.playlist import Playlist
 from cloudplayer.api.model.playlist_item import PlaylistItem
 
@@ -52,3 +56,53 @@ async def test_playlist_can_be_deleted_with_cascading_tracks(
     db.expunge_all()
     assert not db.query(Playlist).get(playlist_ids)
     assert not db.query(PlaylistItem).get(item_ids)
+
+
+@pytest.mark.gen_test
+async def test_playlists_should_be_streamed_as_chunked_json_array(
+        db, user_fetch, account):
+    for title in ('a', 'b', 'c', 'd', 'e'):
+        db.add(Playlist(
+            title=title,
+            provider_id='cloudplayer',
+            account_id=account.id,
+            account_provider_id=account.provider_id))
+    db.commit()
+
+    response = await user_fetch(
+        '/playlist/cloudplayer?account_id={}'.format(account.id))
+    assert response.headers['Transfer-Encoding'] == 'chunked'
+    assert 'Content-Length' not in response.headers
+    assert sorted(p['title'] for p in response.json()) == list('abcde')
+
+
+@pytest.mark.gen_test
+async def test_playlist_streams_should_abort_on_errors_after_first_batch(
+        db, user_fetch, account):
+    for title in ('a', 'b', 'c', 'd', 'e'):
+        db.add(Playlist(
+            title=title,
+            provider_id='cloudplayer',
+            account_id=account.id,
+            account_provider_id=account.provider_id))
+    db.commit()
+    batches = [PlaylistController._stream]
+
+    def stream(*args):
+        if not batches:
+            raise RuntimeError('lost the cursor')
+        return batches.pop()(*args)
+
+    with mock.patch.object(PlaylistController, '_stream', stream):
+        with pytest.raises(tornado.httpclient.HTTPError) as error:
+            await user_fetch(
+                '/playlist/cloudplayer?account_id={}'.format(account.id))
+    assert error.value.code == 599
+
+
+@pytest.mark.gen_test
+async def test_playlists_should_be_streamed_as_empty_json_array(
+        user_fetch, account):
+    response = await user_fetch(
+        '/playlist/cloudplayer?account_id={}'.format(account.id))
+    assert response.json() == []
@@ -0,0 +1,206 @@
+from unittest import mock
+import urllib.parse
+
+import pytest
+import tornado.gen
+import tornado.options as opt
+
+from cloudplayer.api.controller.playlist_item import PlaylistItemController
+from cloudplayer.api.model.playlist import Playlist
+from cloudplayer.api.model.playlist_item import PlaylistItem
+from cloudplayer.api.util import rank_range
+
+
+def create_playlist(db, account, ranks, names='abcde'):
+    playlist = Playlist(
+        title='test playlist',
+        provider_id='cloudplayer',
+        items=[PlaylistItem(
+            account=account,
+            rank=rank,
+            track_id='track-{}'.format(name),
+            track_provider_id='cloudplayer')
+            for rank, name in zip(ranks, names)],
+        account_id=account.id,
+        account_provider_id=account.provider_id)
+    db.add(playlist)
+    db.commit()
+    return playlist
+
+
+@pytest.fixture(scope='function')
+def playlist(db, account):
+    return create_playlist(db, account, 'ecadb', names='ecadb')
+
+
+@pytest.fixture(scope='function')
+def ranked(db, account):
+    return create_playlist(db, account, rank_range(5))
+
+
+async def move(user_fetch, playlist, name, **position):
+    ids = {i.track_id: i.id for i in playlist.items}
+    body = {k: ids['track-{}'.format(v)] for k, v in position.items()}
+    response = await user_fetch(
+        '/playlist/cloudplayer/{}/item/{}'.format(
+            playlist.id, ids['track-{}'.format(name)]),
+        method='PATCH', body=body)
+    assert response.code == 200
+    response = await user_fetch(
+        '/playlist/cloudplayer/{}/item'.format(playlist.id))
+    items = response.json()
+    return ''.join(i['track_id'][len('track-'):] for i in items), {
+        i['track_id'][len('track-'):]: i['rank'] for i in items}
+
+
+@pytest.mark.gen_test
+async def test_playlist_items_should_be_paginated_by_rank(
+        user_fetch, playlist):
+    path = '/playlist/cloudplayer/{}/item'.format(playlist.id)
+    ranks, cursors = [], []
+    url = '{}?limit=2'.format(path)
+    while url:
+        response = await user_fetch(url)
+        ranks.append([item['rank'] for item in response.json()])
+        cursor = response.headers.get('X-Next-Cursor')
+        cursors.append(cursor)
+        if cursor:
+            link = response.headers['Link']
+            assert link.endswith('>; rel="next"')
+            url = link[1:-len('>; rel="next"')]
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+            assert query == {'after': [cursor], 'limit': ['2']}
+        else:
+            assert 'Link' not in response.headers
+            url = None
+    assert ranks == [['a', 'b'], ['c', 'd'], ['e']]
+    assert cursors[-1] is None
+
+
+@pytest.mark.gen_test
+async def test_playlist_items_should_be_limited_to_max_page_size(
+        user_fetch, playlist, monkeypatch):
+    monkeypatch.setattr(opt.options, 'max_page_size', 3)
+    response = await user_fetch(
+        '/playlist/cloudplayer/{}/item?limit=10'.format(playlist.id))
+    assert [item['rank'] for item in response.json()] == ['a', 'b', 'c']
+    assert response.headers['X-Next-Cursor']
+
+
+@pytest.mark.gen_test
+async def test_playlist_items_should_not_be_paginated_without_page(
+        user_fetch, playlist, monkeypatch):
+    monkeypatch.setattr(opt.options, 'max_page_size', 3)
+    response = await user_fetch(
+        '/playlist/cloudplayer/{}/item'.format(playlist.id))
+    assert [item['rank'] for item in response.json()] == list('abcde')
+    assert 'X-Next-Cursor' not in response.headers
+    assert 'Link' not in response.headers
+
+
+@pytest.mark.gen_test
+@pytest.mark.parametrize('query', [
+    'after=not-a-cursor', 'after=WzFd', 'limit=0', 'limit=many'])
+async def test_playlist_items_should_reject_invalid_pages(
+        user_fetch, playlist, query):
+    response = await user_fetch(
+        '/playlist/cloudplayer/{}/item?{}'.format(playlist.id, query),
+        raise_error=False)
+    assert response.code == 400
+
+
+@pytest.mark.gen_test
+@pytest.mark.parametrize('name, position, order', [
+    ('a', {'after': 'c'}, 'bcade'),
+    ('e', {'before': 'b'}, 'aebcd'),
+    ('d', {'after': 'a', 'before': 'b'}, 'adbce'),
+    ('b', {'after': 'e'}, 'acdeb'),
+    ('d', {'before': 'a'}, 'dabce')])
+async def test_playlist_items_should_be_moved_by_ranking_one_item(
+        user_fetch, ranked, name, position, order):
+    before = {i.track_id[len('track-'):]: i.rank for i in ranked.items}
+    result, ranks = await move(user_fetch, ranked, name, **position)
+    assert result == order
+    assert {k: v for k, v in ranks.items() if v != before[k]}.keys() == {
+        name}
+
+
+@pytest.mark.gen_test
+async def test_playlist_items_with_foreign_ranks_should_be_rebalanced(
+        user_fetch, playlist):
+    result, ranks = await move(user_fetch, playlist, 'e', after='a')
+    assert result == 'aebcd'
+    assert ranks['a'] == 'i0'
+
+
+@pytest.mark.gen_test
+async def test_playlist_items_should_reject_positions_out_of_order(
+        user_fetch, ranked):
+    ids = {i.track_id: i.id for i in ranked.items}
+    response = await user_fetch(
+        '/playlist/cloudplayer/{}/item/{}'.format(ranked.id, ids['track-c']),
+        method='PATCH', raise_error=False,
+        body={'after': ids['track-e'], 'before': ids['track-a']})
+    assert response.code == 400
+
+
+@pytest.mark.gen_test
+async def test_playlist_items_with_long_ranks_should_schedule_rebalance(
+        user_fetch, ranked, monkeypatch):
+    monkeypatch.setattr(opt.options, 'rank_rebalance_length', 1)
+    with mock.patch.object(
+            PlaylistItemController, 'schedule_rebalance') as schedule:
+        result, _ = await move(user_fetch, ranked, 'a', after='b')
+    assert result == 'bacde'
+    schedule.assert_called_once_with((ranked.id, 'cloudplayer'))
+
+
+@pytest.mark.gen_test
+async def test_playlist_item_controller_should_rebalance_in_background(
+        db, current_user, ranked):
+    controller = PlaylistItemController(db, current_user)
+    item = ranked.items[0]
+    item.rank = ranked.items[1].rank + 'i'
+    db.commit()
+    key = (ranked.id, 'cloudplayer')
+    controller.schedule_rebalance(key)
+    await tornado.gen.moment
+    await controller.REBALANCE_FLIGHT.futures[key]
+    db.expire_all()
+    assert [(i.track_id, i.rank) for i in ranked.items] == [
+        ('track-b', 'i0'), ('track-a', 'i1'), ('track-c', 'i2'),
+        ('track-d', 'i3'), ('track-e', 'i4')]
+
+
+@pytest.mark.gen_test
+async def test_playlist_items_should_rebalance_before_exceeding_rank_column(
+        user_fetch, db, account, monkeypatch):
+    monkeypatch.setattr(PlaylistItemController, 'MAX_RANK_LENGTH', 3)
+    playlist = create_playlist(db, account, ['i0', 'i1', 'i1i', 'i1ii', 'i2'])
+    with mock.patch.object(
+            PlaylistItemController, 'schedule_rebalance') as schedule:
+        result, ranks = await move(
+            user_fetch, playlist, 'e', after='c', before='d')
+    assert result == 'abced'
+    assert ranks == {
+        'a': 'i0', 'b': 'i1', 'c': 'i2', 'e': 'i2i', 'd': 'i3'}
+    assert not schedule.called
+
+
+@pytest.mark.gen_test
+async def test_playlist_items_of_others_should_not_be_placed(
+        user_fetch, db, other, monkeypatch):
+    monkeypatch.setattr(opt.options, 'rank_rebalance_length', 1)
+    playlist = create_playlist(db, other, rank_range(5))
+    ids = {i.track_id: i.id for i in playlist.items}
+    with mock.patch.object(
+            PlaylistItemController, '_lock') as lock, mock.patch.object(
+            PlaylistItemController, 'schedule_rebalance') as schedule:
+        response = await user_fetch(
+            '/playlist/cloudplayer/{}/item/{}'.format(
+                playlist.id, ids['track-a']),
+            method='PATCH', raise_error=False,
+            body={'after': 'no-such-item'})
+    assert response.code == 404
+    assert not lock.called
+    assert not schedule.called
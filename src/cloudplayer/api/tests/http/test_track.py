@@ -0,0 +1,25 @@
+import pytest
+import tornado.gen
+import tornado.options as opt
+
+from cloudplayer.api.controller.track import YoutubeTrackController
+
+
+@pytest.mark.gen_test
+async def test_track_collection_should_mark_missing_providers(
+        user_fetch, monkeypatch):
+    async def slow_search(self, ids, kw, fields=None):
+        await tornado.gen.sleep(opt.options.search_budget + 1)
+
+    monkeypatch.setattr(YoutubeTrackController, 'search', slow_search)
+    response = await user_fetch('/track?q=test')
+    assert response.headers['X-Missing-Providers'] == 'youtube'
+    assert {t['provider_id'] for t in response.json()} == {'soundcloud'}
+
+
+@pytest.mark.gen_test
+async def test_track_collection_should_not_mark_complete_results(user_fetch):
+    response = await user_fetch('/track?q=test')
+    assert 'X-Missing-Providers' not in response.headers
+    assert {t['provider_id'] for t in response.json()} == {
+        'soundcloud', 'youtube'}
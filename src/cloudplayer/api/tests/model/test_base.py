@@ -0,0 +1,144 @@
+import datetime
+import json
+
+import pytest
+
+from cloudplayer.api.access import Fields
+from cloudplayer.api.model.account import Account
+from cloudplayer.api.model.base import (Encoder, Transient, inspect_relation,
+                                        parse_fields, render, serialize)
+from cloudplayer.api.model.image import Image
+from cloudplayer.api.model.playlist import Playlist
+from cloudplayer.api.model.playlist_item import PlaylistItem
+from cloudplayer.api.model.track import Track
+
+
+def test_parse_fields_should_split_dotted_names_into_tree():
+    flat, tree = parse_fields(frozenset([
+        'id', 'image.small', 'image.large', 'account.image.small']))
+    assert set(flat) == {'id', 'image', 'account'}
+    tree = {k: set(v) for k, v in tree}
+    assert tree == {
+        'image': {'small', 'large'},
+        'account': {'image.small'}}
+
+
+def test_parse_fields_should_be_memoized_per_field_set():
+    values = frozenset(['id', 'image.small'])
+    assert parse_fields(values) is parse_fields(frozenset(values))
+
+
+def test_inspect_relation_should_be_memoized_per_class():
+    assert inspect_relation(Playlist, 'items') == (True, True)
+    assert inspect_relation(Playlist, 'image') == (True, False)
+    info = inspect_relation.cache_info()
+    inspect_relation(Playlist, 'items')
+    assert inspect_relation.cache_info().hits == info.hits + 1
+
+
+def test_model_fields_should_expand_relations_from_cached_tree():
+    playlists = [
+        Playlist(title='a', image=Image(small='s', large='l')),
+        Playlist(title='b', image=Image(small='t', large='m'))]
+    for playlist in playlists:
+        playlist.fields = Fields('id', 'title', 'image.small')
+    first, second = playlists
+    assert set(first.fields) == {'id', 'title', 'image'}
+    assert set(first.image.fields) == {'small'}
+    assert first.fields is second.fields
+    assert first.image.fields is second.image.fields
+
+
+def make_track(i):
+    track = Track(
+        id=str(i),
+        provider_id='youtube',
+        account=Account(
+            id='channel', provider_id='youtube', title='Channel',
+            image=Image(small='s.jpg', medium='m.jpg', large='l.jpg')),
+        aspect_ratio=0.5625,
+        duration=217,
+        favourite_count=12,
+        image=Image(small='s.jpg', medium='m.jpg', large='l.jpg'),
+        play_count=3456,
+        title='Track {}'.format(i),
+        created=datetime.datetime(2018, 1, 2, 3, 4, 5))
+    track.fields = Track.__acl__[0].fields
+    return track
+
+
+def make_item(i):
+    item = PlaylistItem(
+        id=i,
+        playlist_id='abcd',
+        playlist_provider_id='cloudplayer',
+        rank=str(i),
+        track_provider_id='youtube',
+        track_id=str(i),
+        created=datetime.datetime(2018, 1, 2, 3, 4, 5),
+        updated=datetime.datetime(2018, 1, 2, 3, 4, 5))
+    item.fields = Fields(*PlaylistItem.__fields__)
+    return item
+
+
+def test_serialize_should_render_granted_fields():
+    track = make_track(7)
+    track.fields = Fields('id', 'title', 'created', 'account.image.small')
+    expected = {
+        'id': '7',
+        'title': 'Track 7',
+        'created': '2018-01-02T03:04:05',
+        'account': {'image': {'small': 's.jpg'}}}
+    assert json.loads(serialize(track).decode('utf-8')) == expected
+    assert json.loads(json.dumps(track, cls=Encoder)) == expected
+
+
+def test_render_should_dispatch_on_subclasses():
+    class Custom(Transient):
+        pass
+
+    custom = Custom(id=42)
+    custom.fields = Fields('id')
+    assert render(custom) == {'id': '42'}
+    assert render(datetime.timedelta(seconds=90)) == 90.0
+    with pytest.raises(TypeError):
+        render(object())
+
+
+class LegacyEncoder(json.JSONEncoder):
+
+    def default(self, obj):
+        try:
+            return json.JSONEncoder.default(self, obj)
+        except:  # NOQA
+            if isinstance(obj, Transient):
+                dict_ = {f: getattr(obj, f) for f in obj.fields}
+                if dict_.get('id'):
+                    dict_['id'] = str(dict_['id'])
+                return dict_
+            elif isinstance(obj, datetime.datetime):
+                return obj.isoformat()
+            return json.JSONEncoder.default(self, obj)
+
+
+def legacy_serialize(payload):
+    return json.dumps(payload, cls=LegacyEncoder).encode('utf-8')
+
+
+@pytest.mark.parametrize('make', [make_track, make_item])
+def test_serialize_should_match_exception_based_encoder(make):
+    payload = [make(i) for i in range(10)]
+    assert json.loads(serialize(payload).decode('utf-8')) == json.loads(
+        legacy_serialize(payload).decode('utf-8'))
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('make, size', [
+    (make_track, 50),
+    (make_item, 1000)])
+def test_serialize_should_outperform_exception_based_encoder(
+        throughput, make, size):
+    payload = [make(i) for i in range(size)]
+    before = throughput('legacy_per_second', legacy_serialize, payload)
+    after = throughput('serialized_per_second', serialize, payload)
+    assert after > before
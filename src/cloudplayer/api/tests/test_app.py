@@ -1,6 +1,15 @@
 from unittest import mock
+import concurrent.futures
+import json
+import threading
+import time
+
 import pytest
+import sqlalchemy as sql
+import tornado.gen
 import tornado.httpclient
+import tornado.ioloop
+import tornado.options as opt
 
 import cloudplayer.api.app
 import cloudplayer.api.http.base
@@ -41,6 +50,36 @@ def test_application_should_connect_to_configured_database(app):
         'postgresql://postgres:@127.0.0.1:8852/postgres')
 
 
+def test_database_should_configure_engine_pool_from_options(app):
+    pool = app.database.engine.pool
+    assert isinstance(pool, cloudplayer.api.app.MeteredPool)
+    assert pool.size() == 5
+    assert pool._max_overflow == 10
+    assert pool._timeout == 30
+    assert pool._pre_ping is True
+
+
+def test_database_should_record_pool_metrics(app):
+    session = app.database.create_session()
+    session.execute('SELECT 1 = 1;').first()
+    session.close()
+    summary = app.metrics.summary()
+    assert summary['histograms']['database.pool.wait_ms']['count'] > 0
+    assert summary['histograms']['database.pool.checkout_ms']['count'] > 0
+    assert summary['gauges']['database.pool.size'] == 5
+    assert summary['gauges']['database.pool.checked_out'] >= 0
+
+
+def test_database_should_expose_immutable_provider_client_ids(app):
+    app.database.populate_providers()
+    assert dict(app.database.client_ids) == {
+        'youtube': 'yt-api-key',
+        'soundcloud': 'sc-api-key',
+        'cloudplayer': 'cp-api-key'}
+    with pytest.raises(TypeError):
+        app.database.client_ids['youtube'] = 'other-key'
+
+
 def test_database_should_create_sessions_bound_to_engine(app):
     session = app.database.create_session()
     assert session.get_bind() is app.database.engine
@@ -61,3 +100,194 @@ def test_application_shuts_down_database_events_and_redis(
     assert not app.event_mapper.listeners
     dispose_pool.assert_called_once()
     disconnect_redis.assert_called_once()
+
+
+def test_event_mapper_should_publish_events_after_commit(app, db, account):
+    pipeline = mock.MagicMock()
+    with mock.patch('redis.Redis.pipeline', return_value=pipeline):
+        account.title = 'foo'
+        db.flush()
+        assert db.info['events']
+        pipeline.publish.assert_not_called()
+        db.commit()
+
+    channel = 'account.cloudplayer.{}'.format(account.id)
+    published_channel, message = pipeline.publish.call_args[0]
+    assert published_channel == channel
+    assert isinstance(message, bytes)
+    message = json.loads(message.decode('utf-8'))
+    assert message['channel'] == channel
+    assert message['method'] == 'put'
+    assert message['body']['title'] == 'foo'
+    pipeline.execute.assert_called_once()
+    assert 'events' not in db.info
+
+
+def test_event_mapper_should_serialize_bodies_once_for_all_channels(
+        app, db, account, monkeypatch):
+    from cloudplayer.api.model import base
+    monkeypatch.setattr(account, '__channel__', (
+        'account.{provider_id}.{id}', 'mirror.{provider_id}.{id}'))
+    pipeline = mock.MagicMock()
+    with mock.patch('redis.Redis.pipeline', return_value=pipeline), \
+            mock.patch.object(base, 'serialize', wraps=base.serialize) as ser:
+        account.title = 'foo'
+        db.commit()
+
+    assert [c for c in ser.call_args_list if c[0][0] is account] == [
+        mock.call(account)]
+    messages = [json.loads(c[0][1].decode('utf-8'))
+                for c in pipeline.publish.call_args_list]
+    assert [m['channel'] for m in messages] == [
+        'account.cloudplayer.{}'.format(account.id),
+        'mirror.cloudplayer.{}'.format(account.id)]
+    assert messages[0]['body'] == messages[1]['body']
+
+
+def test_event_mapper_should_discard_events_on_rollback(app, db, account):
+    pipeline = mock.MagicMock()
+    with mock.patch('redis.Redis.pipeline', return_value=pipeline):
+        account.title = 'foo'
+        db.flush()
+        db.rollback()
+        db.commit()
+
+    pipeline.publish.assert_not_called()
+    assert 'events' not in db.info
+
+
+def test_database_should_create_sessions_without_executor_by_default(app):
+    session = app.database.create_session()
+    assert session.executor is None
+
+
+@pytest.mark.gen_test
+async def test_session_should_run_work_inline_without_executor(app):
+    session = cloudplayer.api.app.Session(bind=app.database.engine)
+    result = await session.run(lambda a, b=None: (a, b), 1, b=2)
+    assert result == (1, 2)
+
+
+@pytest.fixture(scope='function')
+def async_database(app):
+    pytest.importorskip('asyncpg')
+    pytest.importorskip('greenlet')
+    database = cloudplayer.api.app.Database(
+        opt.options.postgres_user,
+        opt.options.postgres_password,
+        opt.options.postgres_host,
+        opt.options.postgres_port,
+        opt.options.postgres_db,
+        use_asyncio=True)
+    yield database
+    database.shutdown()
+
+
+@pytest.mark.gen_test
+async def test_async_database_should_await_queries_without_threads(
+        async_database):
+    session = async_database.create_session()
+    assert isinstance(session, cloudplayer.api.app.AsyncioSession)
+    thread = threading.get_ident()
+
+    def query():
+        assert threading.get_ident() == thread
+        return session.execute(sql.text('SELECT 1')).scalar()
+
+    with mock.patch.object(
+            tornado.ioloop.IOLoop, 'run_in_executor') as run_in_executor:
+        results = await tornado.gen.multi([session.run(query)] * 3)
+        await session.close()
+    assert results == [1, 1, 1]
+    assert not run_in_executor.called
+
+
+@pytest.mark.gen_test
+async def test_async_database_should_serve_controller_crud(
+        async_database, current_user, account):
+    from cloudplayer.api.controller.playlist import PlaylistController
+    from cloudplayer.api.model import serialize
+    session = async_database.create_session()
+    controller = PlaylistController(session, current_user)
+    ids = {'provider_id': 'cloudplayer'}
+    created = await controller.create(ids, {
+        'title': 'async', 'account_id': account.id,
+        'account_provider_id': account.provider_id})
+    read = await controller.read(dict(ids, id=created.id))
+    updated = await controller.update(
+        dict(ids, id=created.id), {'title': 'awaited'})
+    found = await controller.search(ids, {'account_id': account.id})
+    body = json.loads(await session.run(serialize, found))
+    await controller.delete(dict(ids, id=created.id))
+    await session.close()
+    assert read.id == updated.id == created.id
+    assert [p['title'] for p in body] == ['awaited']
+
+
+@pytest.mark.gen_test
+async def test_session_should_run_offloaded_work_one_call_at_a_time(app):
+    executor = concurrent.futures.ThreadPoolExecutor(4)
+    session = cloudplayer.api.app.Session(
+        executor=executor, bind=app.database.engine)
+    running = []
+
+    def work(i):
+        running.append(i)
+        time.sleep(0.02)
+        assert running == [i]
+        running.remove(i)
+        return i
+
+    results = await tornado.gen.multi([session.run(work, i) for i in range(4)])
+    executor.shutdown()
+    assert results == [0, 1, 2, 3]
+
+
+async def measure_ioloop_lag(session_factory, concurrency=4, rounds=2):
+    """Probe ioloop responsiveness while slow queries are in flight."""
+    lags = []
+    done = False
+
+    async def probe():
+        while not done:
+            start = time.time()
+            await tornado.gen.sleep(0.01)
+            lags.append(time.time() - start - 0.01)
+
+    async def slow_query():
+        session = session_factory()
+        try:
+            await session.run(
+                lambda: session.execute('SELECT pg_sleep(0.25);').first())
+        finally:
+            session.close()
+
+    prober = tornado.gen.convert_yielded(probe())
+    for _ in range(rounds):
+        await tornado.gen.multi([slow_query() for _ in range(concurrency)])
+    done = True
+    await prober
+    lags.sort()
+    return lags[int(len(lags) * 0.99)] if lags else float('inf')
+
+
+@pytest.mark.benchmark
+@pytest.mark.gen_test(timeout=30)
+async def test_offloaded_sessions_keep_ioloop_responsive_under_slow_queries(
+        app, record_property):
+    executor = concurrent.futures.ThreadPoolExecutor(4)
+    engine = app.database.engine
+
+    def offloaded():
+        return cloudplayer.api.app.Session(executor=executor, bind=engine)
+
+    def inline():
+        return cloudplayer.api.app.Session(bind=engine)
+
+    offloaded_p99 = await measure_ioloop_lag(offloaded)
+    inline_p99 = await measure_ioloop_lag(inline)
+    executor.shutdown()
+
+    record_property('offloaded_lag_p99', offloaded_p99)
+    record_property('inline_lag_p99', inline_p99)
+    assert inline_p99 > offloaded_p99
@@ -0,0 +1,113 @@
+from unittest import mock
+import threading
+
+import pytest
+import redis.exceptions
+import tornado.gen
+
+from cloudplayer.api.cache import LRUCache, SingleFlight, TieredCache
+from cloudplayer.api.metrics import Metrics
+
+
+def test_lru_cache_should_evict_least_recently_used_items():
+    cache = LRUCache(size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_lru_cache_should_expire_items_after_ttl():
+    cache = LRUCache(ttl=10)
+    with mock.patch('time.time', return_value=100):
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=60)
+    with mock.patch('time.time', return_value=109):
+        assert cache.get('a') == 1
+    with mock.patch('time.time', return_value=110):
+        assert cache.get('a', 'missing') == 'missing'
+        assert cache.get('b') == 2
+
+
+def test_lru_cache_should_not_store_already_expired_items():
+    cache = LRUCache()
+    cache.set('a', 1, ttl=-1)
+    assert 'a' not in cache
+    cache.set('b', 2)
+    cache.delete('b')
+    assert 'b' not in cache
+
+
+@pytest.mark.gen_test
+async def test_tiered_cache_should_read_through_to_redis(app, cache):
+    metrics = Metrics()
+    tiered = TieredCache('test', app.redis_pool, metrics=metrics)
+    await tiered.set_many({'a': {'title': 'foo'}}, ttl=30)
+    assert 0 < cache.ttl('test.a') <= 30
+    tiered.local.clear()
+    assert await tiered.get_many(['a', 'b']) == {'a': {'title': 'foo'}}
+    assert tiered.local.get('a') == {'title': 'foo'}
+    assert metrics.counter('test.cache.hits').value == 1
+    assert metrics.counter('test.cache.misses').value == 1
+
+
+@pytest.mark.gen_test
+async def test_tiered_cache_should_fall_back_to_local_tier(app):
+    tiered = TieredCache('test', app.redis_pool)
+    error = redis.exceptions.ConnectionError('unavailable')
+    with mock.patch('redis.Redis.mget', side_effect=error):
+        with mock.patch('redis.client.Pipeline.execute', side_effect=error):
+            await tiered.set('a', 1)
+            assert await tiered.get('a') == 1
+            assert await tiered.get('b') is None
+
+
+@pytest.mark.gen_test
+async def test_tiered_cache_should_call_redis_off_the_ioloop(app):
+    tiered = TieredCache('test', app.redis_pool)
+    threads = []
+
+    def mget(cache, keys):
+        threads.append(threading.get_ident())
+        return [None] * len(keys)
+
+    with mock.patch('redis.Redis.mget', mget):
+        assert await tiered.get_many(['a', 'b']) == {}
+    assert threads and threading.get_ident() not in threads
+
+
+@pytest.mark.gen_test
+async def test_single_flight_should_coalesce_concurrent_calls():
+    flight = SingleFlight()
+    calls = []
+
+    async def work(value):
+        calls.append(value)
+        await tornado.gen.sleep(0.01)
+        return value
+
+    results = await tornado.gen.multi([
+        flight.do('key', work, 1),
+        flight.do('key', work, 2),
+        flight.do('other', work, 3)])
+    assert results == [1, 1, 3]
+    assert calls == [1, 3]
+    assert not flight.futures
+
+
+@pytest.mark.gen_test
+async def test_single_flight_should_share_exceptions():
+
+    async def fail():
+        raise ValueError('upstream error')
+
+    flight = SingleFlight()
+    futures = [flight.do('key', fail), flight.do('key', fail)]
+    for future in futures:
+        with pytest.raises(ValueError):
+            await future
+    assert not flight.futures
@@ -18,6 +18,16 @@ def test_handler_mixin_should_connect_redis_pool(app):
     assert handler.cache.info()
 
 
+def test_handler_mixin_should_share_the_application_multiplexer(app):
+    class Handler(HandlerMixin):
+        application = app
+
+    handler = Handler()
+    assert handler.pubsub is handler.pubsub
+    assert handler.pubsub.multiplexer is app.multiplexer
+    assert not handler.pubsub.subscribed
+
+
 def test_handler_mixin_should_create_db_session(app):
     class Handler(HandlerMixin):
         application = app
@@ -43,6 +53,18 @@ def test_handler_mixin_should_close_db_on_finish(app):
     assert handler.finished
 
 
+@pytest.mark.gen_test
+async def test_handler_mixin_should_render_through_db_session():
+    class Handler(HandlerMixin):
+        db = mock.Mock(run=asynctest.CoroutineMock(return_value=b'{}'))
+
+    handler = Handler()
+    assert await handler.render({'a': 1}) == b'{}'
+    handler.db.run.assert_called_once_with(
+        cloudplayer.api.handler.serialize, {'a': 1})
+    assert await handler.render(None) is None
+
+
 def test_handler_should_write_errors_to_out_proto():
     class Handler(HandlerMixin):
         write = asynctest.MagicMock()
@@ -119,6 +141,9 @@ class DummyHandler(object):
         self.pubsub = None
         self.current_user = None
 
+    async def render(self, data):
+        return data
+
     def write(self, chunk):
         self.written = chunk
 
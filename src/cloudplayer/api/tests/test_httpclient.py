@@ -0,0 +1,29 @@
+import pytest
+import tornado.httpclient
+import tornado.options as opt
+
+from cloudplayer.api.httpclient import CurlHTTPClient, enable_keepalive
+
+
+def test_configured_httpclient_should_be_pooled_curl_client(app):
+    client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+    try:
+        assert isinstance(client, CurlHTTPClient)
+        assert client.max_clients == opt.options.http_max_clients
+        assert client.defaults['prepare_curl_callback'] is enable_keepalive
+        assert client.defaults['request_timeout'] == 3
+        assert client.metrics is app.metrics
+    finally:
+        client.close()
+
+
+@pytest.mark.gen_test
+async def test_curl_client_should_record_queue_wait(app, base_url):
+    client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+    histogram = app.metrics.histogram('httpclient.queue_ms')
+    count = histogram.count
+    try:
+        await client.fetch('{}/health_check'.format(base_url))
+    finally:
+        client.close()
+    assert histogram.count == count + 1
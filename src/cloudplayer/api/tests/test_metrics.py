@@ -0,0 +1,49 @@
+from cloudplayer.api.metrics import Counter, Histogram, Metrics, percentile
+
+
+def test_percentile_should_pick_nearest_rank_of_sorted_samples():
+    assert percentile([], 0.5) is None
+    assert percentile([1, 2, 3, 4], 0.5) == 3
+    assert percentile([1, 2, 3, 4], 0.99) == 4
+    assert percentile([1, 2, 3, 4], 1.0) == 4
+
+
+def test_counter_should_increment_by_amount():
+    counter = Counter()
+    counter.increment()
+    counter.increment(41)
+    assert counter.summary() == 42
+
+
+def test_histogram_should_summarize_observations():
+    histogram = Histogram()
+    for value in range(1, 101):
+        histogram.observe(value)
+    assert histogram.summary() == {
+        'count': 100,
+        'sum': 5050.0,
+        'p50': 51,
+        'p90': 91,
+        'p99': 100,
+        'max': 100}
+
+
+def test_histogram_should_only_keep_recent_samples_for_percentiles():
+    histogram = Histogram(size=10)
+    for value in range(100):
+        histogram.observe(value)
+    assert histogram.count == 100
+    assert histogram.percentile(0.0) == 90
+
+
+def test_metrics_should_create_and_summarize_named_instruments():
+    metrics = Metrics()
+    assert metrics.counter('foo') is metrics.counter('foo')
+    assert metrics.histogram('bar') is metrics.histogram('bar')
+    metrics.counter('foo').increment()
+    metrics.histogram('bar').observe(1.5)
+    metrics.gauge('baz', lambda: 73)
+    summary = metrics.summary()
+    assert summary['counters'] == {'foo': 1}
+    assert summary['histograms']['bar']['count'] == 1
+    assert summary['gauges'] == {'baz': 73}
@@ -0,0 +1,154 @@
+from unittest import mock
+import time
+
+import pytest
+import redis
+import redis.exceptions
+import tornado.gen
+
+from cloudplayer.api.pubsub import Listener, Multiplexer, Subscription
+
+
+def subscribed_pubsub(app, **handlers):
+    cache = redis.Redis(connection_pool=app.redis_pool)
+    pubsub = cache.pubsub()
+    pubsub.subscribe(keep_alive=lambda _: True, **handlers)
+    return pubsub
+
+
+async def wait_for(condition, timeout=1.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        await tornado.gen.sleep(0.001)
+
+
+@pytest.mark.gen_test
+async def test_listener_should_deliver_messages_when_readable(app):
+    received = []
+    pubsub = subscribed_pubsub(app, foo=received.append)
+    listener = Listener()
+    listener.add(pubsub)
+    await wait_for(lambda: False, timeout=0.05)
+
+    redis.Redis(connection_pool=app.redis_pool).publish('foo', 'bar')
+    await wait_for(lambda: received)
+    listener.remove(pubsub)
+    pubsub.close()
+
+    assert [m['data'] for m in received] == [b'bar']
+    assert not listener.pubsubs
+
+
+@pytest.mark.gen_test
+async def test_listener_should_report_lost_connections(app):
+    pubsub = subscribed_pubsub(app)
+    on_error = mock.MagicMock()
+    listener = Listener()
+    listener.add(pubsub, on_error=on_error)
+    get_message = mock.MagicMock(
+        side_effect=redis.exceptions.ConnectionError('gone'))
+    pubsub.get_message = get_message
+    listener.read(pubsub, None, None)
+    pubsub.close()
+
+    assert on_error.call_count == 1
+    assert not listener.pubsubs
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('idle_subscriptions', [1000, 10000])
+@pytest.mark.gen_test(timeout=60)
+async def test_multiplexer_delivery_latency_and_cpu_with_idle_subscriptions(
+        app, record_property, idle_subscriptions):
+    idle = [app.multiplexer.subscription() for _ in range(idle_subscriptions)]
+    for i, subscription in enumerate(idle):
+        subscription.subscribe(**{'idle.{}'.format(i): mock.Mock()})
+    received = []
+    active = app.multiplexer.subscription()
+    active.subscribe(foo=lambda m: received.append(time.time()))
+    cache = redis.Redis(connection_pool=app.redis_pool)
+    while not received:
+        cache.publish('foo', 'warm-up')
+        await wait_for(lambda: received, timeout=0.1)
+
+    cpu_start = time.process_time()
+    await tornado.gen.sleep(0.5)
+    idle_cpu = time.process_time() - cpu_start
+
+    latencies = []
+    for _ in range(20):
+        del received[:]
+        sent = time.time()
+        cache.publish('foo', 'bar')
+        await wait_for(lambda: received)
+        latencies.append(received[0] - sent)
+
+    for subscription in idle + [active]:
+        subscription.close()
+
+    latencies.sort()
+    record_property('idle_cpu_seconds', idle_cpu)
+    record_property('delivery_latency_max', latencies[-1])
+    assert idle_cpu < 0.1
+    assert latencies[-1] < 0.05
+
+
+def test_multiplexer_should_refcount_channels_on_one_connection():
+    multiplexer = Multiplexer(None, Listener())
+    multiplexer.pubsub = pubsub = mock.Mock()
+    multiplexer.ensure_connected = mock.Mock()
+    one, two = multiplexer.subscription(), multiplexer.subscription()
+
+    one.subscribe(foo=mock.Mock())
+    two.subscribe(foo=mock.Mock(), bar=mock.Mock())
+    assert pubsub.subscribe.call_count == 2
+    assert multiplexer.channels == {'foo': {one, two}, 'bar': {two}}
+
+    one.unsubscribe('foo')
+    assert not pubsub.unsubscribe.called
+    assert multiplexer.channels == {'foo': {two}, 'bar': {two}}
+
+    two.close()
+    assert pubsub.unsubscribe.call_count == 2
+    assert multiplexer.channels == {}
+    assert not two.subscribed
+
+
+def test_multiplexer_should_fan_out_messages_to_subscriptions():
+    multiplexer = Multiplexer(None, Listener())
+    multiplexer.pubsub = mock.Mock()
+    multiplexer.ensure_connected = mock.Mock()
+    one, two, other = mock.Mock(), mock.Mock(), mock.Mock()
+    multiplexer.subscription().subscribe(foo=one)
+    multiplexer.subscription().subscribe(foo=two, bar=other)
+
+    message = {'type': 'message', 'channel': b'foo', 'data': b'42'}
+    multiplexer.dispatch(message)
+    one.assert_called_once_with(message)
+    two.assert_called_once_with(message)
+    assert not other.called
+
+
+def test_subscription_should_ignore_unknown_channels():
+    multiplexer = mock.Mock()
+    subscription = Subscription(multiplexer)
+    subscription.unsubscribe('foo')
+    subscription.deliver('foo', {})
+    assert not multiplexer.detach.called
+
+
+@pytest.mark.gen_test
+async def test_multiplexer_should_deliver_over_a_single_redis_connection(app):
+    multiplexer = Multiplexer(app.redis_pool, Listener())
+    received = []
+    subscriptions = [multiplexer.subscription() for _ in range(10)]
+    for subscription in subscriptions:
+        subscription.subscribe(foo=received.append)
+    await wait_for(lambda: False, timeout=0.05)
+
+    redis.Redis(connection_pool=app.redis_pool).publish('foo', 'bar')
+    await wait_for(lambda: len(received) == 10)
+    assert len(multiplexer.listener.pubsubs) == 1
+    multiplexer.shutdown()
+
+    assert [m['data'] for m in received] == [b'bar'] * 10
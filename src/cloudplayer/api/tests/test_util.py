@@ -1,4 +1,9 @@
-from cloudplayer.api.util import gen_token, chunk_range, squeeze
+import random
+
+import pytest
+
+from cloudplayer.api.util import (chunk_range, gen_token, rank_between,
+                                  rank_range, squeeze)
 
 
 def test_token_generator_should_create_token():
@@ -27,3 +32,50 @@ def test_squeeze_should_reduce_string_to_non_whitespace_chars():
     lines
     and words .
     """) == 'multiplelinesandwords.'
+
+
+def test_rank_between_should_sort_between_bounds():
+    assert rank_between() == 'i0'
+    assert rank_between('i0') == 'i1'
+    assert rank_between(None, 'i0') == 'hz'
+    assert rank_between('iz') == 'j00'
+    assert 'i0' < rank_between('i0', 'i1') < 'i1'
+    assert 'i0' < rank_between('i0', 'i0i') < 'i0i'
+    assert 'hz' < rank_between('hz', 'i0') < 'i0'
+
+
+@pytest.mark.parametrize('lower, upper', [
+    ('i1', 'i0'), ('i0', 'i0'), ('aaa', None), (None, 'i'),
+    ('i00', None), ('I0', None), ('', None)])
+def test_rank_between_should_reject_invalid_ranks(lower, upper):
+    with pytest.raises(ValueError):
+        rank_between(lower, upper)
+
+
+def test_rank_range_should_generate_short_consecutive_ranks():
+    ranks = rank_range(5000)
+    assert ranks[:3] == ['i0', 'i1', 'i2']
+    assert ranks == sorted(set(ranks))
+    assert max(len(r) for r in ranks) == 4
+    assert rank_between(ranks[-1]) > ranks[-1]
+
+
+def test_rank_between_should_keep_appends_and_prepends_short():
+    first = last = rank_between()
+    for _ in range(5000):
+        first, last = rank_between(None, first), rank_between(last, None)
+    assert len(first) <= 4
+    assert len(last) <= 4
+
+
+def test_rank_between_should_keep_ranks_short_over_many_reorders():
+    rng = random.Random(73)
+    ranks = rank_range(5000)
+    for _ in range(10000):
+        del ranks[rng.randrange(len(ranks))]
+        index = rng.randrange(len(ranks) + 1)
+        lower = ranks[index - 1] if index else None
+        upper = ranks[index] if index < len(ranks) else None
+        ranks.insert(index, rank_between(lower, upper))
+    assert ranks == sorted(set(ranks))
+    assert max(len(r) for r in ranks) <= 16
@@ -1,5 +1,9 @@
+from unittest import mock
+
 import pytest
 
+from cloudplayer.api.ws.base import WSBase
+
 
 @pytest.mark.gen_test
 async def test_websocket_connection_responds_with_fallback(user_push):
@@ -10,3 +14,14 @@ async def test_websocket_connection_responds_with_fallback(user_push):
         'body': {
             'reason': 'channel not found',
             'status_code': 404}}
+
+
+def test_websocket_forward_should_relay_shared_message_unchanged():
+    message = {'channel': b'account.cloudplayer.1',
+               'data': b'{"channel": "account.cloudplayer.1", "body": {}}'}
+    connections = [mock.Mock(), mock.Mock()]
+    for connection in connections:
+        request = mock.Mock(connection=connection, body={}, query={})
+        WSBase(mock.Mock(), request).forward(message)
+    for connection in connections:
+        connection.write_message.assert_called_once_with(message['data'])
@@ -0,0 +1,50 @@
+import json
+
+import pytest
+import tornado.gen
+import tornado.options as opt
+
+from cloudplayer.api.controller.track import YoutubeTrackController
+
+
+async def read_frames(connection):
+    frames = []
+    while True:
+        frame = json.loads(await connection.read_message())
+        frames.append(frame)
+        if 'provider_id' not in frame:
+            return frames
+
+
+@pytest.mark.gen_test
+async def test_track_search_should_stream_frames_per_provider(user_push):
+    message = {'channel': 'track', 'sequence': 7, 'query': {'q': 'test'}}
+    response = await user_push(message, keep_alive=True, await_reply=False)
+    frames = await read_frames(response.connection)
+    response.connection.close()
+
+    assert {f['sequence'] for f in frames} == {7}
+    assert {f['channel'] for f in frames} == {'track'}
+    assert {f['provider_id'] for f in frames[:-1]} == {
+        'soundcloud', 'youtube'}
+    for frame in frames[:-1]:
+        assert frame['body']
+        assert {t['provider_id'] for t in frame['body']} == {
+            frame['provider_id']}
+    assert frames[-1]['body'] == {'missing': []}
+
+
+@pytest.mark.gen_test
+async def test_track_search_should_stream_fast_providers_first(
+        user_push, monkeypatch):
+    async def slow_search(self, ids, kw, fields=None):
+        await tornado.gen.sleep(opt.options.search_budget + 1)
+
+    monkeypatch.setattr(YoutubeTrackController, 'search', slow_search)
+    message = {'channel': 'track', 'query': {'q': 'test'}}
+    response = await user_push(message, keep_alive=True, await_reply=False)
+    frames = await read_frames(response.connection)
+    response.connection.close()
+
+    assert [f.get('provider_id') for f in frames] == ['soundcloud', None]
+    assert frames[-1]['body'] == {'missing': ['youtube']}
@@ -27,6 +27,137 @@ def chunk_range(size, min_step=10, chunks=multiprocessing.cpu_count()):
     return ranges
 
 
+RANK_DIGITS = string.digits + string.ascii_lowercase
+RANK_ZERO = 'i0'
+RANK_MIN = '0' * 19
+
+
+def _integer_length(head):
+    """Number of digits of the integer part introduced by `head`."""
+    index = RANK_DIGITS.index(head)
+    if index >= RANK_DIGITS.index('i'):
+        return index - RANK_DIGITS.index('i') + 1
+    return RANK_DIGITS.index('h') - index + 1
+
+
+def _split_rank(rank):
+    """Split a rank into its integer and fraction part."""
+    if not rank or any(d not in RANK_DIGITS for d in rank):
+        raise ValueError('invalid rank {!r}'.format(rank))
+    length = _integer_length(rank[0]) + 1
+    integer, fraction = rank[:length], rank[length:]
+    if len(integer) < length or rank == RANK_MIN:
+        raise ValueError('invalid rank {!r}'.format(rank))
+    if fraction.endswith(RANK_DIGITS[0]):
+        raise ValueError('invalid rank {!r}'.format(rank))
+    return integer, fraction
+
+
+def _increment(integer):
+    head, digits = integer[0], list(integer[1:])
+    for i in reversed(range(len(digits))):
+        index = RANK_DIGITS.index(digits[i]) + 1
+        if index < len(RANK_DIGITS):
+            digits[i] = RANK_DIGITS[index]
+            return head + ''.join(digits)
+        digits[i] = RANK_DIGITS[0]
+    if head == 'h':
+        return RANK_ZERO
+    if head == RANK_DIGITS[-1]:
+        return None
+    head = RANK_DIGITS[RANK_DIGITS.index(head) + 1]
+    if head > 'i':
+        digits.append(RANK_DIGITS[0])
+    else:
+        digits.pop()
+    return head + ''.join(digits)
+
+
+def _decrement(integer):
+    head, digits = integer[0], list(integer[1:])
+    for i in reversed(range(len(digits))):
+        index = RANK_DIGITS.index(digits[i]) - 1
+        if index >= 0:
+            digits[i] = RANK_DIGITS[index]
+            return head + ''.join(digits)
+        digits[i] = RANK_DIGITS[-1]
+    if head == 'i':
+        return 'h' + RANK_DIGITS[-1]
+    if head == RANK_DIGITS[0]:
+        return None
+    head = RANK_DIGITS[RANK_DIGITS.index(head) - 1]
+    if head < 'h':
+        digits.append(RANK_DIGITS[-1])
+    else:
+        digits.pop()
+    return head + ''.join(digits)
+
+
+def _midpoint(lower, upper):
+    """Fraction sorting between fractions `lower` and `upper`."""
+    if upper is not None:
+        prefix = 0
+        padded = lower.ljust(len(upper), RANK_DIGITS[0])
+        while prefix < len(upper) and padded[prefix] == upper[prefix]:
+            prefix += 1
+        if prefix:
+            return upper[:prefix] + _midpoint(
+                lower[prefix:], upper[prefix:])
+    low = RANK_DIGITS.index(lower[0]) if lower else 0
+    high = RANK_DIGITS.index(upper[0]) if upper else len(RANK_DIGITS)
+    if high - low > 1:
+        return RANK_DIGITS[(low + high) // 2]
+    if upper and len(upper) > 1:
+        return upper[0]
+    return RANK_DIGITS[low] + _midpoint(lower[1:], None)
+
+
+def rank_between(lower=None, upper=None):
+    """Generate a rank sorting between `lower` and `upper`.
+
+    Ranks are fractional indices made of an integer part, whose first
+    digit tells its length, and an optional fraction. A rank can always
+    be put between two others without changing any of them. Ranks after
+    the last or before the first one step the integer part, so that ranks
+    only grow by a digit whenever its range is exhausted. Omitting
+    `lower` or `upper` generates a rank before or after the other one.
+    """
+    if lower is not None and upper is not None and lower >= upper:
+        raise ValueError('lower rank must sort before upper rank')
+    if lower is None and upper is None:
+        return RANK_ZERO
+    if lower is None:
+        integer, fraction = _split_rank(upper)
+        if integer == RANK_MIN:
+            return integer + _midpoint('', fraction)
+        if fraction:
+            return integer
+        return _decrement(integer)
+    integer, fraction = _split_rank(lower)
+    if upper is None:
+        following = _increment(integer)
+        if following is None:
+            return integer + _midpoint(fraction, None)
+        return following
+    upper_integer, upper_fraction = _split_rank(upper)
+    if integer == upper_integer:
+        return integer + _midpoint(fraction, upper_fraction)
+    following = _increment(integer)
+    if following < upper:
+        return following
+    return integer + _midpoint(fraction, None)
+
+
+def rank_range(count):
+    """Generate `count` consecutive short ranks in ascending order."""
+    ranks = []
+    rank = RANK_ZERO
+    for _ in range(count):
+        ranks.append(rank)
+        rank = _increment(rank)
+    return ranks
+
+
 def squeeze(string):
     """Squeezes any whitespaces or linebreaks out of `string`."""
     return ''.join(string.split())
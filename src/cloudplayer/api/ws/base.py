@@ -5,7 +5,6 @@
     :copyright: (c) 2018 by Nicolas Drebenstedt
     :license: GPL-3.0, see LICENSE for details
 """
-import json
 import sys
 import time
 
@@ -17,7 +16,7 @@ import tornado.httputil
 import tornado.routing
 
 from cloudplayer.api import APIException
-from cloudplayer.api.model import Encoder
+from cloudplayer.api.model import envelope, serialize
 from cloudplayer.api.handler import HandlerMixin
 
 
@@ -110,18 +109,28 @@ class WSBase(object):
             raise WSException(400, 'invalid unicode argument')
 
     def write(self, data):
-        message = json.dumps(
-            {'channel': self.request.channel,
-             'sequence': self.request.sequence,
-             'body': data},
-            cls=Encoder)
-        self.request.connection.write_message(message)
+        self.write_frame(data)
         self.on_finish()
 
-    def forward(self, data):
-        message = data['data'].decode('utf-8')
+    def write_frame(self, data, **kw):
+        """Send `data` without finishing the request.
+
+        Keyword arguments are added to the message next to the body.
+        """
+        body = data if isinstance(data, bytes) else serialize(data)
+        message = envelope(
+            body, channel=self.request.channel,
+            sequence=self.request.sequence, **kw)
         self.request.connection.write_message(message)
 
+    def forward(self, data):
+        """Relay a published message as is.
+
+        The message is shared by all subscribers of a channel and sent
+        without decoding or encoding it again.
+        """
+        self.request.connection.write_message(data['data'])
+
     def finish(self):
         self.request.finish()
 
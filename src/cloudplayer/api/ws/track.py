@@ -0,0 +1,32 @@
+"""
+    cloudplayer.api.ws.track
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    :copyright: (c) 2018 by Nicolas Drebenstedt
+    :license: GPL-3.0, see LICENSE for details
+"""
+from cloudplayer.api.controller.track import TrackController
+from cloudplayer.api.handler import ControllerHandlerMixin
+from cloudplayer.api.ws import WSHandler
+
+
+class Collection(ControllerHandlerMixin, WSHandler):
+    """Streams search results frame by frame as the providers answer.
+
+    Every provider that answers in time is sent as a frame carrying its
+    `provider_id`, the final frame lists the providers that are missing.
+    """
+
+    __controller__ = TrackController
+
+    SUPPORTED_METHODS = ('GET',)
+
+    async def get(self, **ids):
+        missing = []
+        async for provider_id, tracks in self.controller.aggregate(
+                self.query_params):
+            if tracks is None:
+                missing.append(provider_id)
+            else:
+                self.write_frame(tracks, provider_id=provider_id)
+        self.write({'missing': missing})